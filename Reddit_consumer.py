@@ -2,132 +2,502 @@
     Amanda Hanway - Streaming Data, Module 7
     Date: 2/4/23
 
-    This program listens for messages from two queues 
+    This program listens for messages from the queue of each
+    subreddit listing in reddit_config.json (see reddit_config.py)
     on the RabbitMQ server continuously. 
-    It performs transformations on messages when received, 
-    writes the cleaned message to an output file, 
+    It performs the listing's transformation on messages when received, 
+    writes the cleaned message to the listing's output file, 
     and generates an alert message when specific events occur.
 
+    Run several consumers with the same shard_count and a different
+    shard_index to split the listings between them.
+
+    Set replay_dir to reprocess the messages the producer recorded
+    (see reddit_recordlog.py) through the same transforms instead of
+    listening to the server, e.g. after changing the cleaning or alerts.
+
+    Usage: python Reddit_consumer.py [--shard-index 0 --shard-count 2] [--replay record_log] [--help for more]
+
     Author: Amanda Hanway 
     Date: 2/4/23
 """
 
 ######## imports ########
+import argparse
+import functools
 import pika
+import os
 import sys
 import time
-import csv
-import re
-from collections import deque
-from datetime import datetime 
+from datetime import datetime, timezone
+from reddit_message import decode_message
+from reddit_cleaner import clean_text, tokenize
+from reddit_sink import OutputSink
+from reddit_publisher import declare_durable_queue
+from reddit_worker import AckTracker, OrderedWorkerPool
+from reddit_alerts import AlertEngine, PrintAlertSink
+from reddit_analytics import TextAnalytics
+from reddit_config import load_config, queue_arguments, select_listings
+from reddit_eventtime import ReorderBuffer, max_events
+from reddit_store import PostStore
+from reddit_metrics import MetricsExporter, SamplingProfiler, lag_buckets, registry
+from reddit_recordlog import read_log
 
 
 ######## declare constants ########
-# set host and queue name
+# set host name
 host = "localhost"
-queue_name_1 = "dataanalysis_queue"
-queue_name_2 = "todayilearned_queue"
 
-# Create empty deques to store that last 2 messages
-queue_1_deque = deque(maxlen=2)
-queue_2_deque = deque(maxlen=2)
+# set the file that lists the subreddit listings (see reddit_config.py)
+config_path = "reddit_config.json"
+
+# set the routing keys this consumer handles, e.g. "reddit.dataanalysis.*"
+# (* matches one word, # any number of words)
+bind_pattern = "reddit.#"
+
+# set the number of consumers sharing the listings and this consumer's
+# shard (0 to shard_count - 1), each listing is handled by one shard
+shard_count = 1
+shard_index = 0
+
+# set the prefetch window, the number of messages the server may
+# deliver to this consumer before they are acknowledged
+prefetch_count = 100
+
+# set how many finished messages to acknowledge together,
+# messages are acknowledged only after their rows are written
+ack_batch = 50
+
+# set how many seconds finished messages may wait to be acknowledged
+# when no more messages are arriving
+ack_seconds = 1
+
+# set to decode and clean messages on a pool of workers (True)
+# or one at a time on the connection thread (False)
+worker_mode = False
+
+# set the number of workers and whether they are processes (True),
+# which spread the work across cores, or threads (False)
+worker_count = os.cpu_count() or 1
+use_processes = True
+
+# set to print every message received (True) or not (False),
+# printing large messages slows the consumer down
+verbose = True
+
+# set the port to serve metrics on for Prometheus, e.g. 8001 (None = off)
+# and/or a file to write them to every metrics_interval seconds (None = off).
+# The parse stage is not counted when it runs on worker processes.
+metrics_port = None
+metrics_path = None
+metrics_interval = 10
+
+# set a file to write sampled stacks to, for a flame graph (None = off)
+profile_path = None
+
+# Create the SQLite store of posts with typed columns (subreddit, flair,
+# created_utc, delta_seconds, title, text, id, score), indexed for
+# queries by subreddit and created_utc, see reddit_store.py
+post_store = PostStore()
+
+# set to also write the rows to the text output files (True) or
+# to keep the posts only in the SQLite store (False)
+text_output = True
+
+# Create the trending terms and flair of each listing per window, kept in
+# fixed memory (see reddit_analytics.py to set the window and sketch sizes)
+analytics = TextAnalytics()
+
+# set a file to write the trending terms and flair to every
+# analytics_interval seconds (None = off)
+analytics_path = None
+analytics_interval = 60
+
+# set a record log folder to replay instead of listening to the server
+# (None = listen), and optionally the time range to replay, in epoch
+# seconds the messages were published (None = no limit). The replayed
+# rows, store and analytics snapshot are written to files of the same
+# names in replay_output_dir, never to the live ones.
+replay_dir = None
+replay_start = None
+replay_end = None
+replay_output_dir = "replay_output"
+
+# the listings this consumer handles, by queue, filled in by open_streams.
+# Each stream has its listing's config and a long-lived output file that
+# buffers rows between writes (see reddit_sink.py to set the flush, fsync
+# and rotation options, rows are synced to disk before their messages are
+# acknowledged unless fsync_policy="never"). A "gap" stream also has a side output for posts
+# that arrive after the watermark has passed them, and the buffer that puts
+# posts back in created_utc order before the time since the earlier post
+# is found (see reddit_eventtime.py to set the allowed lateness and how
+# long a post may be held).
+streams = {}
+
+# the alert engine, created by open_streams from the alert rules of each
+# listing. It keeps windowed metrics for each listing and sends alerts
+# to its sinks (add a FileAlertSink to keep them in a file)
+alert_engine = None
 
 
 ######## define functions ########
-def callback_1(ch, method, properties, body):
+def format_timestamp(created_utc: int) -> str:
+    """
+    Format the epoch seconds of a post as a local timestamp string
+    Parameters:
+        created_utc (int): when the post was created, in epoch seconds
+    """
+    return datetime.fromtimestamp(created_utc).strftime('%Y-%m-%d, %H:%M:%S')
+
+def open_streams(listings: list, output_dir: str=None, prefetch: int=None, ack_batch: int=1):
+    """
+    Open the output files, reorder buffers and alert engine
+    for the listings this consumer handles
+    Parameters:
+        listings (list): the ListingConfig of each listing
+        output_dir (str): the folder to put the output files in (None = as configured)
+        prefetch (int): the prefetch window the held posts must fit in (None = no limit)
+        ack_batch (int): the finished messages that may wait unacknowledged for a commit
+    """
+    global alert_engine
+    def output_path(path: str) -> str:
+        return path if output_dir is None else os.path.join(output_dir, os.path.basename(path))
+    # held posts are not acknowledged, and neither are up to ack_batch - 1
+    # finished messages waiting for a commit, so the reorder buffers together
+    # must leave room for those and one more delivery in the prefetch window,
+    # or delivery stalls until a timer releases or acknowledges messages
+    hold = max_events
+    gap_count = sum(listing.transform == "gap" for listing in listings)
+    if prefetch is not None and gap_count:
+        hold = min(max_events, (prefetch - min(ack_batch, prefetch)) // gap_count)
+        if hold < max_events:
+            print(f" [*] Holding at most {hold} posts per listing, to fit {gap_count} listings "
+                  f"in a prefetch window of {prefetch}")
+    streams.clear()
+    for listing in listings:
+        stream = {'config': listing, 'sink': OutputSink(output_path(listing.output))}
+        if listing.transform == "gap":
+            stream['late_sink'] = OutputSink(output_path(listing.late_output))
+            stream['buffer'] = ReorderBuffer(max_events=hold)
+            stream['finish'] = functools.partial(finish_gap, stream)
+        else:
+            stream['finish'] = functools.partial(finish_age, stream)
+        streams[listing.queue] = stream
+    # each rule compares a metric to a threshold (see reddit_alerts.py for
+    # the metrics) and the message is formatted with the metrics of the post
+    alert_engine = AlertEngine({listing.name: listing.alerts for listing in listings}, [PrintAlertSink()])
+
+def stream_sinks() -> list:
+    """
+    Get every output file of the open streams
+    """
+    return [stream[key] for stream in streams.values() for key in ('sink', 'late_sink') if key in stream]
+
+@registry.timed("parse")
+def parse_post(body: bytes, content_type: str, content_encoding: str=None) -> dict:
     """ 
-    Define behavior on getting a message from r/dataanalysis/new
-    """
-    # decode the binary message body to a string
-    print(f"\n[x] Received:  {body.decode()}")
-
-    # clean up the text (^=ignore) 
-    clean_string1 = re.sub(re.compile('[^a-zA-Z0-9\\\/\.\-\!?& _"'',:;()<>[]+#$%\\*]|_'), '', body.decode())
-    # remove new lines 
-    clean_string2 = clean_string1.replace("\n", " ")
-    # split the message into columns
-    timestamp = re.findall(r'tms-start/(.+?)/tms-end', clean_string2)
-    subreddit = re.findall(r'sub-start/(.+?)/sub-end', clean_string2)
-    flr = re.findall(r'flair-start/(.+?)/flair-end', clean_string2)  
-    flair = [flr[0].capitalize() if flr[0] != "None" and flr[0] != "" else "No flair"]
-    title_str = re.findall(r'title-start/(.+?)/title-end', clean_string2)
-    text_str = re.findall(r'text-start/(.+?)/text-end', clean_string2)
-
-    # add the message to a deque and find time since previous post
-    # note: posts are in descending order
-    queue_1_deque.append(timestamp[0])
-    time_current = datetime.strptime(queue_1_deque[0], '%Y-%m-%d, %H:%M:%S')
-    time_compare = datetime.strptime(queue_1_deque[-1], '%Y-%m-%d, %H:%M:%S')    
-    time_difference = 0
-    if int(format(time_current, '%Y')) > 2000 :
-        time_difference = time_current - time_compare  
-    hours = int(time_difference.total_seconds() // 3600)
-    remaining_secs = time_difference.total_seconds() - (hours * 3600)
-    mins = remaining_secs // 60
-
-    fullstring = subreddit + flair + timestamp + [str(int(hours)) + " hr. " + str(int(mins)) + " min. since earlier post"] + title_str + text_str 
-    listToStr = ', '.join([str(w) for w in fullstring])   
- 
-    # write message to output file 
-    with open("output_dataanalysis.txt", "a", encoding="utf-8", newline='',) as output_file:
-        writer_analysis = csv.writer(output_file)  
-        writer_analysis.writerow([listToStr]) 
-    
-    # generate alert
-    if hours < 1:
-        print(f" >>>>>>>> ALERT: < 1 Hour Between Posts ({str(int(hours))} hr. {str(int(mins))} min.)")   
-    elif hours > 4:
-        print(f" >>>>>>>> ALERT: > 4 Hours Between Posts ({str(int(hours))} hr. {str(int(mins))} min.)")   
-
-def callback_2(ch, method, properties, body):
+    Decode and clean a message from any listing.
+    This step keeps no state so it can run on a worker.
+    """
+    # decode the record in a single pass
+    record = decode_message(body, content_type, content_encoding)
+    # clean up the text and split the message into columns
+    flr = clean_text(record['link_flair_css_class'])
+    title = clean_text(record['title'])
+    text = clean_text(record['selftext'])
+    return {
+        'created_utc': record['created_utc'],
+        'score': record['score'],
+        'timestamp': format_timestamp(record['created_utc']),
+        'subreddit': clean_text(record['subreddit']),
+        'flair': flr.capitalize() if flr != "" else "No flair",
+        'title': title,
+        'text': text,
+        'id': record['id'],
+        # split the cleaned text into terms here, once, for the analytics
+        'terms': tokenize(title, text)
+    }
+
+def store_post(stream: dict, post: dict, delta_seconds: float=None):
+    """ 
+    Add a post to the SQLite store and count its terms and flair
+    Parameters:
+        stream (dict): the listing's stream
+        post (dict): the parsed post
+        delta_seconds (float): the time since the earlier post, in created_utc
+            order ("gap" listings only, None for late posts and "age" listings)
+    """
+    post_store.write_row({**post, 'delta_seconds': delta_seconds})
+    analytics.observe(stream['config'].name, post['created_utc'], post['terms'],
+                      post['flair'] if post['flair'] != "No flair" else None)
+    # the lag from when the post was created to when it is written
+    registry.histogram("reddit_consumer_lag_seconds", "Seconds from created_utc to the post being written",
+                       lag_buckets, subreddit=post['subreddit'].lower()).observe(time.time() - post['created_utc'])
+
+def analysis_row(post: dict, gap: str) -> str:
+    """ 
+    Join the columns of an r/dataanalysis post into the output row
+    Parameters:
+        post (dict): the parsed post
+        gap (str): the time since the earlier post
+    """
+    # a post without text adds no text column
+    text_str = [post['text']] if post['text'] != "" else []
+    fullstring = [post['subreddit'], post['flair'], post['timestamp']] + [gap] + [post['title']] + text_str 
+    return ', '.join([str(w) for w in fullstring])   
+
+def finish_gap(stream: dict, post: dict, delivery_tag: int) -> list:
     """ 
-    Define behavior on getting a message from r/todayilearned/top/?t=day
+    Hold a post of a "gap" listing (e.g. r/dataanalysis/new) until
+    the watermark passes it, then write the posts released in
+    created_utc order.
+    Messages must be finished in the order they arrived.
+    Returns the delivery tags whose rows are written and the
+    delivery tags of released posts that could not be written.
     """
-    # decode the binary message body to a string
-    print(f"\n[x] Received:  {body.decode()}")
+    if not stream['buffer'].add(post['created_utc'], (post, delivery_tag)):
+        # the watermark already passed this post, so write it to the
+        # late output instead of mixing it into the metrics
+        store_post(stream, post)
+        if text_output:
+            stream['late_sink'].write_row([analysis_row(post, "Late post")])
+        registry.counter("reddit_late_posts_total", "Posts that arrived after the watermark passed them").inc()
+        print(f" [!] Late post ({stream['buffer'].late_count} late so far)")
+        return [delivery_tag], []
+    return release_gap(stream)
 
-    # clean up the text(^=ignore) 
-    clean_string1 = re.sub(re.compile('[^a-zA-Z0-9\\\/\.\-\!?& _"'',:;()<>[]+#$%\\*]|_'), '', body.decode())
-    # remove new lines 
-    clean_string2 = clean_string1.replace("\n", " ")
-    # split the message into columns
-    timestamp = re.findall(r'tms-start/(.+?)/tms-end', clean_string2)
-    subreddit = re.findall(r'sub-start/(.+?)/sub-end', clean_string2)
-    title_str = re.findall(r'title-start/(.+?)/title-end', clean_string2)
+def release_gap(stream: dict, force: bool=False) -> list:
+    """ 
+    Write the posts of a "gap" listing the watermark has passed
+    Parameters:
+        stream (dict): the listing's stream
+        force (bool): write every held post, e.g. when shutting down
+    Returns the delivery tags whose rows are written and the delivery
+    tags of the posts that could not be written. A post that fails does
+    not stop the posts released after it.
+    """
+    written = []
+    failed = []
+    for created_utc, (post, delivery_tag) in stream['buffer'].release(force=force):
+        # the post has left the buffer, so its own message takes the error
+        try:
+            write_gap(stream, post)
+        except Exception as e:
+            print(f"ERROR: message {delivery_tag} could not be processed: {e}")
+            failed.append(delivery_tag)
+            continue
+        written.append(delivery_tag)
+    return written, failed
 
-    # add the message to a deque and find how long since it was posted from now
+def write_gap(stream: dict, post: dict):
+    """ 
+    Find the time since the earlier post of the listing, 
+    generate alerts and write the row.
+    Posts must be written in created_utc order.
+    """
+    # update the listing's metrics, including the time since
+    # the earlier post, and generate alerts
+    metrics = alert_engine.observe(stream['config'].name, post['created_utc'], post['score'])
+    hours = metrics['gap_hours']
+    mins = metrics['gap_mins']
+    if hours is None:
+        gap = "No earlier post"
+    else:
+        gap = str(int(hours)) + " hr. " + str(int(mins)) + " min. since earlier post"
+ 
+    # write message to the store and the output file 
+    store_post(stream, post, metrics['gap_seconds'])
+    if text_output:
+        stream['sink'].write_row([analysis_row(post, gap)])
+
+def finish_age(stream: dict, post: dict, delivery_tag: int) -> list:
+    """ 
+    Find how long ago the post of an "age" listing
+    (e.g. r/todayilearned/top/?t=day) was created,
+    generate alerts and write the row.
+    Messages must be finished in the order they arrived.
+    Returns the delivery tags whose rows are written and
+    the delivery tags that failed (none).
+    """
+    # update the listing's metrics, including how long since
+    # it was posted from now, and generate alerts
     # note: posts are not in chronological order
-    queue_2_deque.append(timestamp[0])
-    time_current = datetime.now()
-    time_compare = datetime.strptime(queue_2_deque[-1], '%Y-%m-%d, %H:%M:%S')    
-    time_difference = time_current - time_compare
-    hours = time_difference.total_seconds() // 3600
-    remaining_secs = time_difference.total_seconds() - (hours * 3600)
-    mins = remaining_secs // 60
-
-    fullstring = subreddit + timestamp + ["Posted " + str(int(hours)) + " hr. " + str(int(mins)) + " min. ago"] + title_str 
+    metrics = alert_engine.observe(stream['config'].name, post['created_utc'], post['score'])
+    hours = metrics['age_hours']
+    mins = metrics['age_mins']
+
+    fullstring = [post['subreddit'], post['timestamp']] + ["Posted " + str(int(hours)) + " hr. " + str(int(mins)) + " min. ago"] + [post['title']] 
     listToStr = ', '.join([str(w) for w in fullstring])  
 
-    # write message to output file  
-    with open("output_todayilearned.txt", "a", newline='', encoding="utf-8") as output_file:
-        writer_til = csv.writer(output_file)  
-        writer_til.writerow([listToStr]) 
+    # write message to the store and the output file, the posts of a
+    # ranked listing arrive by rank, so there is no time since the earlier post
+    store_post(stream, post)
+    if text_output:
+        stream['sink'].write_row([listToStr])
+    return [delivery_tag], []
+
+def make_callback(queue_name: str, parse, finish, tracker: AckTracker, pool: OrderedWorkerPool=None):
+    """
+    Create the on-message callback for a queue
+    Parameters:
+        queue_name (str): the name of the queue
+        parse: the function that decodes and cleans the message
+        finish: the function that writes the row and generates alerts,
+            it returns the delivery tags whose rows are written and
+            the delivery tags of held messages that failed
+        tracker (AckTracker): acknowledges messages once their rows are written
+        pool (OrderedWorkerPool): runs parse on a worker (None = run it here)
+    """
+    def callback(ch, method, properties, body):
+        registry.counter("reddit_messages_consumed_total", "Messages received from each queue",
+                         queue=queue_name).inc()
+        # decode the binary message body to a string
+        if verbose and properties.content_encoding is None:
+            print(f"\n[x] Received:  {body.decode()}")
+        elif verbose:
+            print(f"\n[x] Received:  {len(body)} bytes ({properties.content_encoding})")
+
+        # hand the message to the pool, it is finished in order later
+        if pool is not None:
+            pool.submit(queue_name, method.delivery_tag, parse,
+                        (body, properties.content_type, properties.content_encoding), finish)
+            return
+
+        tracker.received(method.delivery_tag)
+        try:
+            finished, failed = finish(parse(body, properties.content_type, properties.content_encoding),
+                                      method.delivery_tag)
+        except Exception as e:
+            print(f"ERROR: message {method.delivery_tag} could not be processed: {e}")
+            tracker.failed(method.delivery_tag)
+            return
+        for delivery_tag in finished:
+            tracker.done(delivery_tag)
+        for delivery_tag in failed:
+            tracker.failed(delivery_tag)
+    return callback
+
+def release_streams(tracker: AckTracker, force: bool=False):
+    """
+    Write the held posts of every "gap" stream the watermark has passed
+    and mark their messages finished
+    Parameters:
+        tracker (AckTracker): acknowledges messages once their rows are written
+        force (bool): write every held post, e.g. when shutting down
+    """
+    for stream in streams.values():
+        if 'buffer' in stream:
+            finished, failed = release_gap(stream, force)
+            for delivery_tag in finished:
+                tracker.done(delivery_tag)
+            for delivery_tag in failed:
+                tracker.failed(delivery_tag)
+
+def check_sinks(connection, tracker: AckTracker):
+    """
+    Write held posts the watermark has passed or that have waited
+    long enough, write buffered output rows and acknowledge finished
+    messages that have waited long enough, update the queue depths,
+    then schedule the next check
+    Parameters:
+        connection: the blocking connection to the RabbitMQ server
+        tracker (AckTracker): acknowledges messages once their rows are written
+    """
+    release_streams(tracker)
+    for sink in stream_sinks():
+        sink.maybe_flush()
+    post_store.maybe_flush()
+    tracker.commit_if_due(ack_seconds)
+    if analytics_path is not None:
+        analytics.maybe_write_snapshot(analytics_path, analytics_interval)
+    # a passive declare reports the messages waiting without changing the queue
+    for queue_name, stream in streams.items():
+        depth = tracker.channel.queue_declare(queue=queue_name, passive=True).method.message_count
+        registry.gauge("reddit_queue_depth", "Messages waiting in each queue", queue=queue_name).set(depth)
+        if 'buffer' in stream:
+            registry.gauge("reddit_held_posts", "Posts held in the reorder buffer",
+                           queue=queue_name).set(len(stream['buffer']))
+    connection.call_later(ack_seconds, lambda: check_sinks(connection, tracker))
 
-    # generate alert
-    if hours < 1:
-        print(f" >>>>>>>> ALERT: Posted < 1 Hour Ago ({str(int(hours))} hr. {str(int(mins))} min.)")    
-    elif hours > 5:
-        print(f" >>>>>>>> ALERT: Posted > 5 Hours Ago ({str(int(hours))} hr. {str(int(mins))} min.)")       
+def replay(log_dir: str = replay_dir, start: float = replay_start, end: float = replay_end,
+           output_dir: str = replay_output_dir, pattern: str = bind_pattern,
+           index: int = shard_index, count: int = shard_count) -> int:
+    """
+    Reprocess the messages in a record log through the same transforms
+    and alerts as messages from the server, reading the log at disk
+    speed without the broker. The output files, the SQLite store and
+    the analytics snapshot are written in output_dir, apart from the
+    live consumer's.
+    Parameters:
+        log_dir (str): the record log folder
+        start (float): replay the messages published from this time (None = from the start)
+        end (float): replay the messages published up to this time (None = to the end)
+        output_dir (str): the folder to write the output files in
+        pattern (str): the routing keys to handle, e.g. reddit.#
+        index (int): this consumer's shard
+        count (int): the number of consumers sharing the listings
+    Returns the number of messages replayed.
+    """
+    global post_store, analytics
+    listings = select_listings(load_config(config_path)['listings'], pattern, index, count)
+    os.makedirs(output_dir, exist_ok=True)
+    open_streams(listings, output_dir)
+    # keep the replayed posts and terms apart from the live store
+    post_store = PostStore(os.path.join(output_dir, os.path.basename(post_store.path)))
+    analytics = TextAnalytics()
+    snapshot_path = None if analytics_path is None else os.path.join(output_dir, os.path.basename(analytics_path))
+    # find the stream by routing key, or by queue for messages
+    # published straight to a queue
+    routes = {stream['config'].routing_key: stream for stream in streams.values()}
+    routes.update(streams)
+    replayed = 0
+    try:
+        for record in read_log(log_dir, start, end):
+            stream = routes.get(record.routing_key)
+            if stream is None:
+                continue
+            # the record offset stands in for the delivery tag
+            try:
+                _, failed = stream['finish'](parse_post(record.body, record.content_type, record.content_encoding),
+                                             record.offset)
+            except Exception as e:
+                print(f"ERROR: record {record.offset} could not be processed: {e}")
+                failed = [record.offset]
+            registry.counter("reddit_messages_failed_total", "Messages that could not be processed").inc(len(failed))
+            replayed += 1
+    finally:
+        # write the held posts, then every buffered row
+        for stream in streams.values():
+            if 'buffer' in stream:
+                _, failed = release_gap(stream, force=True)
+                registry.counter("reddit_messages_failed_total",
+                                 "Messages that could not be processed").inc(len(failed))
+        for sink in stream_sinks():
+            sink.close()
+        post_store.close()
+        if snapshot_path is not None:
+            analytics.write_snapshot(snapshot_path)
+    print(f" [x] Replayed {replayed} messages from {log_dir} to {output_dir}")
+    return replayed
 
 # main function to run the program
-def main(hn: str = host, qn1: str = queue_name_1, qn2: str = queue_name_2):
+def main(hn: str = host, pattern: str = bind_pattern, index: int = shard_index, count: int = shard_count):
     """ 
-    Continuously listen for task messages on a named queue.
+    Continuously listen for task messages on the queue of each
+    listing this consumer handles.
     Parameters:
         host (str): the host name or IP address of the RabbitMQ server
-        queue_name_1 (str): the name of the first reddit queue
-        queue_name_2 (str): the name of the second reddit queue
+        pattern (str): the routing keys to handle, e.g. reddit.#
+        index (int): this consumer's shard
+        count (int): the number of consumers sharing the listings
     """   
+    # read the listings and keep the ones this consumer handles
+    config = load_config(config_path)
+    listings = select_listings(config['listings'], pattern, index, count)
+    if not listings:
+        print(f"ERROR: no listing in {config_path} matches {pattern} on shard {index} of {count}.")
+        sys.exit(1)
+
     # when a statement can go wrong, use a try-except block
     try:
         # try this code, if it works, keep going
@@ -143,39 +513,71 @@ def main(hn: str = host, qn1: str = queue_name_1, qn2: str = queue_name_2):
         print()
         sys.exit(1)
 
+    tracker = None
+    pool = None
+    # serve or write the metrics and sample the stacks if turned on
+    exporter = MetricsExporter(registry, metrics_port, metrics_path, metrics_interval).start()
+    profiler = SamplingProfiler(profile_path).start() if profile_path is not None else None
     try:
         # use the connection to create a communication channel
         channel = connection.channel()
         
+        # declare the durable topic exchange the producer publishes to
+        channel.exchange_declare(exchange=config['exchange'], exchange_type="topic", durable=True)
+
+        # declare the dead-letter exchange and queue that keep the
+        # messages this consumer could not process
+        channel.exchange_declare(exchange=config['dead_letter_exchange'], exchange_type="fanout", durable=True)
+        channel.queue_declare(queue=config['dead_letter_queue'], durable=True)
+        channel.queue_bind(queue=config['dead_letter_queue'], exchange=config['dead_letter_exchange'])
+
         # do this once for each queue
         # use the channel to declare a durable queue
         # a durable queue will survive a RabbitMQ server restart
         # and help ensure messages are processed in order
         # messages will not be deleted until the consumer acknowledges
-        channel.queue_declare(queue=qn1, durable=True)
-        channel.queue_declare(queue=qn2, durable=True)
+        # and a rejected message goes to the dead-letter exchange
+        # then bind the queue to the listing's routing key
+        # (a queue declared by an earlier version is used as it is)
+        for listing in listings:
+            channel = declare_durable_queue(connection, channel, listing.queue, queue_arguments(config))
+            channel.queue_bind(queue=listing.queue, exchange=config['exchange'], routing_key=listing.routing_key)
+
+        # open the output files of each listing, with reorder buffers
+        # that fit in the prefetch window together
+        open_streams(listings, prefetch=prefetch_count, ack_batch=ack_batch)
 
         # The QoS level controls the # of messages
         # that can be in-flight (unacknowledged by the consumer)
         # at any given time.
-        # Set the prefetch count to one to limit the number of messages
-        # being consumed and processed concurrently.
-        # This helps prevent a worker from becoming overwhelmed
-        # and improve the overall system performance. 
+        # Messages are acknowledged in batches, so the prefetch window
+        # has to hold at least one batch.
         # prefetch_count = Per consumer limit of unaknowledged messages      
-        channel.basic_qos(prefetch_count=1) 
+        channel.basic_qos(prefetch_count=prefetch_count) 
+
+        # acknowledge messages only after their rows are written
+        tracker = AckTracker(channel, [post_store] + stream_sinks(), min(ack_batch, prefetch_count))
+
+        # decode and clean messages on a pool of workers if turned on
+        if worker_mode:
+            pool = OrderedWorkerPool(connection, tracker, worker_count, use_processes)
 
         # do this once for each queue
         # configure the channel to listen on a specific queue,  
-        # use the callback function for the associated queue/channel,
-        # and auto-acknowledge the message  
-        channel.basic_consume(queue=qn1, on_message_callback=callback_1, auto_ack=True)
-        channel.basic_consume(queue=qn2, on_message_callback=callback_2, auto_ack=True)              
+        # use the listing's transform for the associated queue/channel,
+        # and acknowledge the message once its row is written
+        for queue_name, stream in streams.items():
+            channel.basic_consume(queue=queue_name,
+                                  on_message_callback=make_callback(queue_name, parse_post, stream['finish'], tracker, pool))
 
         # print a message to the console for the user
         print(" [*] Ready for work. To exit press CTRL+C")
         print("")
 
+        # write buffered rows and acknowledge messages
+        # even when no messages are arriving
+        check_sinks(connection, tracker)
+
         # start consuming messages via the communication channel
         channel.start_consuming()
 
@@ -190,8 +592,87 @@ def main(hn: str = host, qn1: str = queue_name_1, qn2: str = queue_name_2):
         print(" User interrupted continuous listening process.")
         sys.exit(0)
     finally:
+        # finish the messages still on the pool
+        if pool is not None:
+            pool.shutdown()
+        # write the held posts and any buffered rows, then acknowledge them
+        # (unacknowledged messages are delivered again on restart)
+        try:
+            if tracker is not None and connection.is_open:
+                release_streams(tracker, force=True)
+                tracker.commit()
+        finally:
+            for sink in stream_sinks():
+                sink.close()
+            post_store.close()
+            if analytics_path is not None:
+                analytics.write_snapshot(analytics_path)
+            if profiler is not None:
+                profiler.stop()
+            exporter.close()
         print("\nClosing connection. Goodbye.\n")
-        connection.close()
+        if connection.is_open:
+            connection.close()
+
+
+def parse_time(value: str) -> float:
+    """
+    Read a time option as epoch seconds or an ISO date and time
+    (e.g. 2023-02-04 or 2023-02-04T10:00, UTC unless an offset is given)
+    """
+    try:
+        return float(value)
+    except ValueError:
+        moment = datetime.fromisoformat(value)
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return moment.timestamp()
+
+def parse_args(argv: list=None):
+    """
+    Read the command line options, the settings above are the defaults
+    Parameters:
+        argv (list): the options (None = sys.argv)
+    """
+    parser = argparse.ArgumentParser(description="Process reddit posts from the RabbitMQ server")
+    parser.add_argument("--host", default=host, help="the RabbitMQ server")
+    parser.add_argument("--config", default=config_path, help="the listings file, see reddit_config.py")
+    parser.add_argument("--bind", default=bind_pattern, help="the routing keys to handle, e.g. reddit.dataanalysis.*")
+    parser.add_argument("--shard-index", type=int, default=shard_index, help="this consumer's shard")
+    parser.add_argument("--shard-count", type=int, default=shard_count, help="the consumers sharing the listings")
+    parser.add_argument("--workers", type=int, default=worker_count if worker_mode else 0,
+                        help="decode and clean messages on this many worker processes (0 = none)")
+    parser.add_argument("--quiet", action="store_true", default=not verbose, help="do not print every message")
+    parser.add_argument("--metrics-port", type=int, default=metrics_port, help="serve metrics for Prometheus")
+    parser.add_argument("--analytics", default=analytics_path, help="write the trending terms to this file")
+    parser.add_argument("--replay", default=replay_dir, help="replay this record log instead of listening")
+    parser.add_argument("--replay-start", type=parse_time, default=replay_start, help="replay from this time")
+    parser.add_argument("--replay-end", type=parse_time, default=replay_end, help="replay up to this time")
+    parser.add_argument("--replay-output", default=replay_output_dir, help="write the replayed rows to this folder")
+    return parser.parse_args(argv)
+
+def run(argv: list=None):
+    """
+    Run the consumer from the command line
+    Parameters:
+        argv (list): the options (None = sys.argv)
+    """
+    global config_path, worker_mode, worker_count, verbose, metrics_port, analytics_path
+    args = parse_args(argv)
+    config_path = args.config
+    worker_mode = args.workers > 0
+    worker_count = args.workers or worker_count
+    verbose = not args.quiet
+    metrics_port = args.metrics_port
+    analytics_path = args.analytics
+
+    # replay the record log if turned on,
+    # otherwise listen for messages on the server
+    if args.replay is not None:
+        replay(args.replay, args.replay_start, args.replay_end, args.replay_output,
+               args.bind, args.shard_index, args.shard_count)
+    else:
+        main(args.host, args.bind, args.shard_index, args.shard_count)
 
 
 # Standard Python idiom to indicate main program entry point
@@ -200,6 +681,4 @@ def main(hn: str = host, qn1: str = queue_name_1, qn2: str = queue_name_2):
 # If this is the program being run, then execute the code below
 if __name__ == "__main__":
 
-    main()
-
-
+    run()
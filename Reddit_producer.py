@@ -3,7 +3,18 @@
     Date: 2/4/23
 
     This program gets posts from reddit.com using the reddit API 
-    then streams the post as a message to two queues on the RabbitMQ server.
+    then streams the post as a message to a topic exchange on the RabbitMQ
+    server, which routes each listing into its own queue.
+    The listings are set in reddit_config.json (see reddit_config.py).
+    Every message can also be appended to a local record log
+    (see reddit_recordlog.py) for the consumer to replay.
+    Fetching slows down and pauses when the queues are not being
+    drained or the broker blocks publishing (see reddit_flow.py).
+
+    Usage: python Reddit_producer.py [--once] [--reset-queues] [--help for more]
+    The reddit credentials are read when the producer starts, from
+    environment variables or reddit_login_credentials.txt
+    (see reddit_config.py).
 
     Author: Amanda Hanway 
     Date: 2/4/23
@@ -13,215 +24,401 @@
 '''
 
 ######## imports ########
-import requests
-import pandas as pd
-from datetime import datetime
-import pika
+import argparse
 import sys
-import webbrowser
-import time
+import pika
+from reddit_publisher import Publisher, delivery_mode
+from reddit_scheduler import FetchScheduler, RateLimiter
+from reddit_client import Listing, RedditClient
+from reddit_config import load_config, load_credentials, queue_arguments
+from reddit_dedup import SeenIndex
+from reddit_flow import FlowControl
+from reddit_message import compress_message, content_type, encode_message, message_headers
+from reddit_metrics import MetricsExporter, SamplingProfiler, registry
+from reddit_recordlog import RecordLog
 
 
 ######## declare constants ########
 
-# set reddit connection credentials from a file
-# to keep my credentials private 
-cred = pd.read_csv('reddit_login_credentials.txt')
-username = cred.loc[0][0]
-password = cred.loc[1][0]
-dev_app_name = cred.loc[2][0]
-personal_use_script = cred.loc[3][0]
-secret_token = cred.loc[4][0]
-
-# set source page url 
-# latest posts on the r/dataanalysis subreddit 
-web_page_1 = "https://oauth.reddit.com/r/dataanalysis/new/"
-# top posts on the r/todayilearned subreddit
-web_page_2 = "https://oauth.reddit.com/r/todayilearned/top/?t=day"
-
-# set how many posts to return 
+# the reddit connection credentials are read from environment variables
+# or a file when the producer starts, to keep my credentials private
+# (see load_credentials in reddit_config.py)
+
+# set the reddit api and authentication urls
+# (point these at a local stub server for testing)
+api_url = "https://oauth.reddit.com"
+auth_url = "https://www.reddit.com/api/v1/access_token"
+
+# set the file that lists the subreddit listings to poll,
+# with the queue each one is routed into (see reddit_config.py)
+config_path = "reddit_config.json"
+
+# set how many posts to return on the first polling cycle, and on
+# every cycle of a ranked listing (top, hot) or when a cursor finds nothing
 post_count = 100
 
-# set host and queue name
+# set to keep polling the pages for new posts (True)
+# or to fetch a single cycle and stop (False)
+poll_mode = True
+
+# set how many seconds to wait between polling cycles
+poll_interval = 60
+
+# set how many pages to fetch at the same time
+fetch_workers = 8
+
+# set to pause fetching a listing while its queue is full or has no
+# consumer, and slow down as the queues fill (True), or to always
+# fetch (False). See reddit_flow.py to set the high and low water marks.
+flow_control = True
+
+# set host name
 host = "localhost"
-queue_name_1 = "dataanalysis_queue"
-queue_name_2 = "todayilearned_queue"
+
+# publishers kept open for the life of the process, one per host
+publishers = {}
+
+# set the folder to record every published message in, so the consumer
+# can replay them later without the broker (None = do not record)
+record_log_dir = None
+
+# the record log kept open for the life of the process
+record_logs = {}
+
+# set the file that remembers which posts were already published,
+# so a restarted producer does not publish them again
+seen_index_path = "seen_posts.db"
+
+# set to delete the queues at startup (True), which throws away
+# any messages not yet consumed, or to keep them (False)
+reset_queues = False
 
 # set to turn on (true) or turn off (false) asking the 
-# user if they'd like to open the RabbitMQ Admin site 
-show_offer = True
+# user if they'd like to open the RabbitMQ Admin site,
+# it is only asked when the producer runs in a terminal
+show_offer = False
+
+# set to print every message sent (True) or not (False),
+# printing large messages slows the producer down
+verbose = True
+
+# set the port to serve metrics on for Prometheus, e.g. 8000 (None = off)
+# and/or a file to write them to every metrics_interval seconds (None = off)
+metrics_port = None
+metrics_path = None
+metrics_interval = 10
+
+# set a file to write sampled stacks to, for a flame graph (None = off)
+profile_path = None
 
 
 ######## define functions ########
 
 def offer_rabbitmq_admin_site(show_offer: str=show_offer):
     """
-    Offer to open the RabbitMQ Admin website
+    Offer to open the RabbitMQ Admin website,
+    never waiting for an answer when there is no terminal
     """
-    if show_offer == True:
+    if show_offer == True and sys.stdin.isatty():
         ans = input("Would you like to monitor RabbitMQ queues? y or n:  ")
         print()
         if ans.lower() == "y":
+            import webbrowser
             webbrowser.open_new("http://localhost:15672/#/queues")
             print()
 
 def delete_queue(host: str, queue_name: str):    
     """
     Delete a queue to clear un-needed messages
-    if the code had been run previously
+    if the code had been run previously,
+    on the shared publisher's connection
     Parameters:
         host (str): the host name or IP address of the RabbitMQ server
         queue_name (str): the name of the queue
     """
-    # create a blocking connection to the RabbitMQ server
-    conn = pika.BlockingConnection(pika.ConnectionParameters(host))
-    # use the connection to create a communication channel
-    ch = conn.channel()
-    # delete the queue
-    ch.queue_delete(queue=queue_name)    
+    get_publisher(host).delete_queue(queue_name)
 
-def send_message(host: str, queue_name: str, message: str):
+def get_publisher(host: str) -> Publisher:
     """
-    Create and send a message to the queue each execution.
-    This process runs and finishes.
+    Get the publisher for a host, creating it on first use
+    so one connection and channel are kept per process
     Parameters:
         host (str): the host name or IP address of the RabbitMQ server
-        queue_name (str): the name of the queue
-        message (str): the message to be sent to the queue
-    """
-    try:       
-        # create a blocking connection to the RabbitMQ server
-        conn = pika.BlockingConnection(pika.ConnectionParameters(host))
-        # use the connection to create a communication channel
-        ch = conn.channel()
-        # use the channel to declare a durable queue
-        # a durable queue will survive a RabbitMQ server restart
-        # and help ensure messages are processed in order
-        # messages will not be deleted until the consumer acknowledges
-        ch.queue_declare(queue=queue_name, durable=True)
-        # use the channel to publish a message to the queue
-        # every message passes through an exchange
-        ch.basic_publish(exchange="", routing_key=queue_name, body=message)
-        # print a message to the console for the user
+    """
+    if host not in publishers:
+        publishers[host] = Publisher(host)
+    return publishers[host]
+
+def get_record_log(directory: str) -> RecordLog:
+    """
+    Get the record log for a folder, opening it on first use
+    Parameters:
+        directory (str): the log folder
+    """
+    if directory not in record_logs:
+        record_logs[directory] = RecordLog(directory)
+    return record_logs[directory]
+
+def send_message(host: str, queue_name: str, message: bytes, exchange: str=""):
+    """
+    Add a message to the publisher's batch for the queue.
+    The publisher keeps its connection open between messages,
+    publishes full batches with a publisher confirm for each message, 
+    and reconnects if the connection to the server is lost.
+    Parameters:
+        host (str): the host name or IP address of the RabbitMQ server
+        queue_name (str): the name of the queue, or the routing key
+            when publishing to an exchange
+        message (bytes): the encoded record to be sent to the queue
+        exchange (str): the exchange ("" = straight to the queue)
+    """
+    # compress a large message (see reddit_message.py for the settings)
+    body, content_encoding = compress_message(message)
+    # set the content type, encoding and schema version so the consumer
+    # can decode the record without inspecting the body, and make the
+    # message persistent so the durable queue keeps it across a restart
+    properties = pika.BasicProperties(content_type=content_type, content_encoding=content_encoding,
+                                      headers=message_headers(), delivery_mode=delivery_mode)
+    # use the shared publisher to publish the message to the queue
+    with registry.timer("publish"):
+        get_publisher(host).publish(queue_name, body, properties, exchange)
+    # record the message as published, if turned on
+    if record_log_dir is not None:
+        get_record_log(record_log_dir).append(queue_name, body, content_type, content_encoding)
+    # print a message to the console for the user
+    if verbose:
         print(f" [x] Sent {message}\n")
-    except pika.exceptions.AMQPConnectionError as e:
-        print(f"Error: Connection to RabbitMQ server failed: {e}")
-        sys.exit(1)
-    finally:
-        # close the connection to the server
-        conn.close()
 
-def df_from_response(res):
-    '''
-    Convert the response for a post to a dataframe
-    '''
-    # initialize temp dataframe for batch of data in response
-    df = pd.DataFrame()
-
-    # loop through each post pulled from res and append to df_list
-    df_list = []
-    for post in res.json()['data']['children']:
-        df_list.append({     
-            'subreddit': post['data']['subreddit'],
-            'title': post['data']['title'],
-            'selftext': post['data']['selftext'],
-            'upvote_ratio': post['data']['upvote_ratio'],
-            'ups': post['data']['ups'],
-            'downs': post['data']['downs'],
-            'score': post['data']['score'],
-            'link_flair_css_class': post['data']['link_flair_css_class'],
-            'created_utc': datetime.fromtimestamp(post['data']['created_utc']).strftime('%Y-%m-%d, %H:%M:%S'),
-            'id': post['data']['id'],
-            'kind': post['kind']
-        })
-    
-    # convert the list of dictionaries to a dataframe
-    df = pd.DataFrame.from_dict(df_list)
-
-    return df
+def fetch_new_posts(client: RedditClient, page: str, cursor: str=None, limit: int=post_count):
+    """
+    Fetch the posts on a listing that are newer than the cursor.
+    Each page of the listing is requested once per cycle.
+    On the first cycle (no cursor) page forward with 'after'
+    until limit posts are collected, otherwise page backward
+    with 'before' from the cursor until no newer posts remain.
+    Only use a cursor on a time-ordered listing (new), on a ranked
+    listing 'before' returns only the posts ranked above it.
+    If the cursor's post was removed, 'before' returns nothing every
+    cycle, so an empty first page falls back to the first limit posts
+    of the listing and the posts already published are skipped by the
+    caller (see SeenIndex).
+    Parameters:
+        client (RedditClient): the shared reddit api client
+        page (str): the listing url
+        cursor (str): fullname of the newest post already published
+        limit (int): the maximum number of posts to return without a cursor
+    Returns:
+        a Listing of the new posts in listing order
+        and the fullname of the newest post (the next cursor)
+    """
+    # create a list to store each page of new posts
+    page_list = []
+    collected = 0
+    params = {}
+    if cursor is not None:
+        params['before'] = cursor
+
+    # with a cursor keep paging until the newest post is reached
+    while cursor is not None or collected < limit:
+        params['limit'] = 100 if cursor is not None else min(100, limit - collected)
+        # make request and get the posts from the response
+        new_posts = client.get_posts(page, params=params)
+        if len(new_posts) == 0:
+            break
+        collected += len(new_posts)
+
+        if cursor is None:
+            # page forward from the final post (oldest entry)
+            page_list.append(new_posts)
+            params['after'] = new_posts[-1].fullname
+        else:
+            # page backward from the first post (newest entry),
+            # newer pages go in front to keep the listing order
+            page_list.insert(0, new_posts)
+            params['before'] = new_posts[0].fullname
+
+        # a short page means the end of the listing was reached
+        if len(new_posts) < params['limit']:
+            break
+
+    # nothing newer than the cursor: either no new posts, or the cursor's
+    # post was removed, so read the first posts again without a cursor
+    if not page_list and cursor is not None:
+        return fetch_new_posts(client, page, None, limit)
+
+    # nothing on the listing, keep the cursor
+    if not page_list:
+        return Listing(), cursor
+
+    # join the pages into a single listing
+    posts = Listing([post for new_posts in page_list for post in new_posts])
+    return posts, posts[0].fullname
 
 # main function to run the program
-def main(un: str=username, pw: str=password, app_nm: str=dev_app_name):
+def main(un: str=None, pw: str=None, app_nm: str=None):
     '''
     Request an OAuth token and connect the reddit api 
-    then request data from the webpage and add it to a dataframe
-    then create a message and send to the queue
+    then poll each listing in the configuration file for new posts
+    then create a message for each new post and send to the exchange
     Parameters:
-        username (str): reddit.com username
-        password (str): reddit.com password
-        dev_app_name (str): name of reddit.com api application
+        username (str): reddit.com username (None = from the credentials)
+        password (str): reddit.com password (None = from the credentials)
+        dev_app_name (str): name of reddit.com api application (None = from the credentials)
     '''
-    # authenticate API
-    client_auth = requests.auth.HTTPBasicAuth(personal_use_script, secret_token)
-    data = {
-        'grant_type': 'password',
-        'username': un,
-        'password': pw
-    }
-    headers = {'User-Agent': app_nm}
-
-    # send authentication request for OAuth token
-    res = requests.post('https://www.reddit.com/api/v1/access_token',
-                        auth=client_auth, data=data, headers=headers)
-    # extract token from response and format correctly
-    token = f"bearer {res.json()['access_token']}"
-    # update API headers with authorization (bearer token)
-    headers = {**headers, **{'Authorization': token}}
-
-    # initialize dataframe and parameters for pulling data in loop
-    data = pd.DataFrame()
-    params = {'limit': post_count}
-
-    # loop through n times for each webpage
-    for i in range(post_count):
-        for p in [web_page_1, web_page_2]:
-            # make request
-            res = requests.get(p,
-                            headers=headers,
-                            params=params)
-
-            # set the queue name
-            queue_name = queue_name_1 if p == web_page_1 else queue_name_2
-
-            # get dataframe from response
-            data = df_from_response(res)
-
-            # create a message for the row of data 
-            fstring_message = f"tms-start/{data.loc[i]['created_utc']}/tms-end"\
-                            f", sub-start/{data.loc[i]['subreddit']}/sub-end"\
-                            f", flair-start/{data.loc[i]['link_flair_css_class']}/flair-end"\
-                            f", title-start/{data.loc[i]['title']}/title-end"\
-                            f", text-start/{data.loc[i]['selftext']}/text-end"
-
-            # prepare a binary (1s and 0s) message to stream
-            message = fstring_message.encode()
-
-            # send the message
-            send_message(host, queue_name, message)
-
-            # wait 2 seconds
-            time.sleep(2)
+    # read the credentials now rather than when the module is imported
+    cred = load_credentials()
+    # share one rate budget, read from reddit's rate limit headers,
+    # between the pages that are fetched at the same time
+    limiter = RateLimiter()
+    # create the api client, it requests the OAuth token on first use
+    # and requests a new one before it expires
+    client = RedditClient(un or cred.username, pw or cred.password, app_nm or cred.dev_app_name,
+                          cred.personal_use_script, cred.secret_token, auth_url=auth_url, limiter=limiter)
+
+    # read the listings to poll, by url
+    config = load_config(config_path)
+    exchange = config['exchange']
+    pages = {listing.url(api_url): listing for listing in config['listings']}
+
+    # route each listing into its own durable queue, so no message
+    # is lost before a consumer binds to it, declared with the same
+    # dead-letter exchange as the consumer declares it with
+    for listing in pages.values():
+        get_publisher(host).bind(exchange, listing.queue, listing.routing_key, arguments=queue_arguments(config))
+
+    # store the fullname of the newest post published from each
+    # time-ordered page, a ranked page has no cursor and is fetched
+    # from the top every cycle (see cursor_paging in reddit_config.py)
+    cursors = {p: None for p in pages}
+
+    # fetch the pages at the same time
+    scheduler = FetchScheduler(lambda p: fetch_new_posts(client, p, cursors[p]), fetch_workers)
+
+    # open the index of posts that were already published
+    seen = SeenIndex(seen_index_path)
+
+    # pause the listings whose queue is not being drained
+    flow = FlowControl()
+
+    # serve or write the metrics and sample the stacks if turned on
+    exporter = MetricsExporter(registry, metrics_port, metrics_path, metrics_interval).start()
+    profiler = SamplingProfiler(profile_path).start() if profile_path is not None else None
+
+    try:
+        # fetch each page once per cycle and publish only the new posts
+        while True:
+            # wait while the broker has blocked publishing (memory or disk alarm)
+            get_publisher(host).wait_while_blocked()
+
+            # fetch only the pages whose queue can take more messages,
+            # a paused page keeps its cursor and catches up when it resumes
+            ready = list(pages)
+            if flow_control:
+                flow.update(get_publisher(host), [listing.queue for listing in pages.values()])
+                ready = [p for p in pages if flow.allowed(pages[p].queue)]
+
+            # publish each page as soon as its fetch is done
+            for p, (posts, cursor) in scheduler.run_cycle(ready):
+                if pages[p].cursor_paging:
+                    cursors[p] = cursor
+
+                # skip the posts that were already published
+                unseen = seen.unseen(post.id for post in posts)
+                new_posts = [post for post in posts if post.id in unseen]
+                registry.counter("reddit_posts_fetched_total", "Posts fetched from each page", page=p).inc(len(posts))
+
+                # publish the oldest post first so the messages
+                # arrive close to created_utc (event time) order
+                for post in reversed(new_posts):
+                    # create a binary (1s and 0s) JSON record for the post
+                    message = encode_message(post.to_dict())
+
+                    # send the message to the exchange with the listing's routing key
+                    send_message(host, pages[p].routing_key, message, exchange)
+
+                # publish what is left of the batch for this page,
+                # then remember the posts once the broker has confirmed them
+                get_publisher(host).flush()
+                seen.add([post.id for post in new_posts])
+                if record_log_dir is not None:
+                    get_record_log(record_log_dir).flush()
+
+            # stop after one cycle unless polling
+            if not poll_mode:
+                break
+
+            # wait for the next polling cycle, longer as the queues fill
+            get_publisher(host).sleep(flow.poll_wait(poll_interval) if flow_control else poll_interval)
+    finally:
+        scheduler.close()
+        client.close()
+        seen.close()
+        for record_log in record_logs.values():
+            record_log.close()
+        if profiler is not None:
+            profiler.stop()
+        exporter.close()
  
 
-# Standard Python idiom to indicate main program entry point
-# This allows us to import this module and use its functions
-# without executing the code below.
-# If this is the program being run, then execute the code below
-if __name__ == "__main__":  
+def parse_args(argv: list=None):
+    """
+    Read the command line options, the settings above are the defaults
+    Parameters:
+        argv (list): the options (None = sys.argv)
+    """
+    parser = argparse.ArgumentParser(description="Stream reddit posts to the RabbitMQ server")
+    parser.add_argument("--host", default=host, help="the RabbitMQ server")
+    parser.add_argument("--config", default=config_path, help="the listings file, see reddit_config.py")
+    parser.add_argument("--once", action="store_true", default=not poll_mode, help="fetch one cycle and stop")
+    parser.add_argument("--poll-interval", type=float, default=poll_interval, help="seconds between cycles")
+    parser.add_argument("--reset-queues", action="store_true", default=reset_queues,
+                        help="delete the queues, and their messages, first")
+    parser.add_argument("--offer-admin", action="store_true", default=show_offer,
+                        help="ask to open the RabbitMQ Admin site")
+    parser.add_argument("--quiet", action="store_true", default=not verbose, help="do not print every message")
+    parser.add_argument("--metrics-port", type=int, default=metrics_port, help="serve metrics for Prometheus")
+    parser.add_argument("--record-log", default=record_log_dir, help="record every message in this folder")
+    return parser.parse_args(argv)
+
+def run(argv: list=None):
+    """
+    Run the producer from the command line
+    Parameters:
+        argv (list): the options (None = sys.argv)
+    """
+    global host, config_path, poll_mode, poll_interval, verbose, metrics_port, record_log_dir
+    args = parse_args(argv)
+    host = args.host
+    config_path = args.config
+    poll_mode = not args.once
+    poll_interval = args.poll_interval
+    verbose = not args.quiet
+    metrics_port = args.metrics_port
+    record_log_dir = args.record_log
 
     # if show_offer is turned on (True) then
     # ask the user if they'd like to open the RabbitMQ Admin site 
-    offer_rabbitmq_admin_site() 
-
-    # delete the queue if run previously
-    delete_queue(host, queue_name_1)
-    delete_queue(host, queue_name_2)
-
-    # get the message from the webpage
-    # send the message to the queue
-    main()
-
-  
+    offer_rabbitmq_admin_site(args.offer_admin)
+
+    try:
+        # delete the queue if run previously and turned on,
+        # otherwise already published posts are skipped using the seen index
+        if args.reset_queues:
+            for listing in load_config(config_path)['listings']:
+                delete_queue(host, listing.queue)
+
+        # get the message from the webpage
+        # send the message to the queue
+        main()
+    finally:
+        # publish any buffered messages and close the connection
+        get_publisher(host).close()
 
 
+# Standard Python idiom to indicate main program entry point
+# This allows us to import this module and use its functions
+# without executing the code below.
+# If this is the program being run, then execute the code below
+if __name__ == "__main__":  
 
+    run()
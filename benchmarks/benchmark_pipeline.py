@@ -0,0 +1,739 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This program measures the producer and consumer without a reddit
+    account or a RabbitMQ server, so a change can be checked for speed
+    before it is kept.
+
+    - A local HTTP stub (in its own process) serves the token and listing
+      endpoints with listing JSON built from the posts recorded in
+      supporting_files/data.csv, with large selftext bodies mixed in.
+      It pages with limit / after / before like reddit and reports a
+      large rate limit budget.
+    - An in-memory broker stands in for RabbitMQ. It gives the producer's
+      Publisher and the consumer the connection and channel methods they
+      use (confirms, queue and topic exchange declares, bindings, prefetch,
+      consume, multiple acks, rejects, call_later and add_callback_threadsafe).
+      It never blocks publishing.
+      The default listings of reddit_config.py are polled from the stub.
+
+    The benchmark runs in two passes:
+        pipeline - Reddit_producer.main and Reddit_consumer.main run at the
+                   same time, for producer msgs/s and end-to-end latency
+                   (from basic_publish to the ack sent after the row is written)
+        drain    - Reddit_consumer.main alone over every message of the first
+                   pass, already queued, for consumer msgs/s
+
+    CPU time is kept per stage on the thread that ran it:
+        fetch, encode, publish (producer) and parse, finish, write, alert,
+        analytics (consumer). finish includes the alert, analytics and
+        buffered write calls it makes.
+
+    Messages the consumer could not process (reddit_messages_failed_total)
+    are reported and make the run an error, since they were rejected
+    instead of written. The stores and output files are kept in a
+    temporary folder that is removed after the run.
+
+    Every run is appended to benchmarks/results.jsonl with the git commit,
+    and compared with the last run using the same settings.
+
+    Usage: python benchmarks/benchmark_pipeline.py [--posts 1000] [--selftext-bytes 40000] [--quiet]
+'''
+
+######## imports ########
+import argparse
+import contextlib
+import csv
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+# use the producer and consumer modules in the parent folder
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(repo_dir)
+from reddit_config import credential_env, topic_matches
+from reddit_metrics import registry
+
+
+######## declare constants ########
+
+# set the recorded posts the listings are built from
+recorded_posts_path = os.path.join(repo_dir, "supporting_files", "data.csv")
+
+# set the file every run is appended to
+results_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl")
+
+# set how many posts each listing serves (and the producer fetches)
+posts_per_listing = 1000
+
+# set the size of the large selftext bodies and how often they appear
+# (every nth post of a listing)
+selftext_bytes = 40000
+large_every = 4
+
+# set the rate limit budget the stub reports on every response
+stub_remaining = 1000000
+stub_reset = 600
+
+# the listings the stub serves, with the seconds between posts and
+# whether the posts carry selftext (r/todayilearned posts are titles only)
+stub_listings = {
+    "dataanalysis": {"sort": "new", "gap": 900, "selftext": True},
+    "todayilearned": {"sort": "top", "gap": 60, "selftext": False},
+}
+
+
+######## define functions ########
+
+def recorded_posts(path: str=recorded_posts_path) -> list:
+    """
+    Read the recorded posts with created_utc in epoch seconds
+    Parameters:
+        path (str): the data.csv dump of a listing
+    """
+    with open(path, newline='', encoding='utf-8') as data_file:
+        rows = list(csv.DictReader(data_file))
+    for row in rows:
+        row['created_utc'] = int(datetime.strptime(row['created_utc'], '%Y-%m-%dT%H:%M:%SZ')
+                                 .replace(tzinfo=timezone.utc).timestamp())
+    return rows
+
+def build_listing(subreddit: str, count: int, gap: int, with_selftext: bool, text_bytes: int,
+                  every: int, rows: list, now: int) -> list:
+    """
+    Build the children of a listing, newest first, from the recorded posts
+    Parameters:
+        subreddit (str): the subreddit of the listing
+        count (int): the number of posts
+        gap (int): the seconds between posts
+        with_selftext (bool): keep the recorded selftext and pad every nth post
+        text_bytes (int): the size of a padded selftext
+        every (int): pad every nth post
+        rows (list): the recorded posts
+        now (int): the created_utc of the newest post
+    """
+    rng = random.Random(subreddit)
+    children = []
+    for i in range(count):
+        row = rows[i % len(rows)]
+        selftext = row['selftext'] if with_selftext else ""
+        if with_selftext and every and i % every == 0:
+            seed = (row['selftext'] or row['title']) + "\n"
+            selftext = (seed * (text_bytes // len(seed) + 1))[:text_bytes]
+        score = rng.randint(0, 5000)
+        children.append({'kind': 't3', 'data': {
+            'subreddit': subreddit,
+            'title': row['title'],
+            'selftext': selftext,
+            'upvote_ratio': float(row['upvote_ratio'] or 1.0),
+            'ups': score,
+            'downs': 0,
+            'score': score,
+            'link_flair_css_class': row['link_flair_css_class'] or None,
+            'created_utc': float(now - i * gap),
+            'id': f"{subreddit[:2]}{i:06d}",
+        }})
+    return children
+
+def listing_page(children: list, limit: int, after: str=None, before: str=None) -> dict:
+    """
+    Get one page of a listing the way reddit pages it:
+    'after' returns the posts following a fullname (older posts),
+    'before' the posts just ahead of it (newer posts)
+    Parameters:
+        children (list): the whole listing, newest first
+        limit (int): the most posts on the page
+        after (str): the fullname to page forward from
+        before (str): the fullname to page backward from
+    """
+    positions = {f"{c['kind']}_{c['data']['id']}": i for i, c in enumerate(children)}
+    if after is not None:
+        start = positions.get(after, len(children) - 1) + 1
+        page = children[start:start + limit]
+    elif before is not None:
+        end = positions.get(before, 0)
+        page = children[max(0, end - limit):end]
+    else:
+        page = children[:limit]
+    fullnames = [f"{c['kind']}_{c['data']['id']}" for c in page]
+    return {'kind': 'Listing', 'data': {
+        'children': page,
+        'after': fullnames[-1] if fullnames else None,
+        'before': fullnames[0] if fullnames else None,
+    }}
+
+def serve_stub(port_queue, count: int, text_bytes: int, every: int):
+    """
+    Run the reddit API stub until the process is stopped,
+    putting its port on port_queue once it is listening
+    """
+    rows = recorded_posts()
+    now = int(time.time())
+    listings = {name: build_listing(name, count, spec['gap'], spec['selftext'], text_bytes, every, rows, now)
+                for name, spec in stub_listings.items()}
+    # encoded pages, so the stub answers without rebuilding them
+    pages = {}
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, body: bytes):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("X-Ratelimit-Remaining", str(stub_remaining))
+            self.send_header("X-Ratelimit-Reset", str(stub_reset))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.reply(json.dumps({'access_token': 'benchmark', 'token_type': 'bearer',
+                                   'expires_in': 86400}).encode())
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            subreddit = url.path.strip("/").split("/")[1]
+            key = (subreddit, int(query.get('limit', ['25'])[0]),
+                   query.get('after', [None])[0], query.get('before', [None])[0])
+            if key not in pages:
+                pages[key] = json.dumps(listing_page(listings[subreddit], *key[1:])).encode()
+            self.reply(pages[key])
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+@contextlib.contextmanager
+def reddit_stub(count: int, text_bytes: int, every: int):
+    """
+    Start the reddit API stub in its own process, so serving the
+    listings is not counted in the benchmark's CPU time
+    Returns:
+        the base url of the stub
+    """
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_stub, args=(port_queue, count, text_bytes, every), daemon=True)
+    process.start()
+    try:
+        yield f"http://127.0.0.1:{port_queue.get(timeout=60)}"
+    finally:
+        process.terminate()
+        process.join()
+
+def percentile(values: list, q: float):
+    """
+    Get the q-th percentile (0 to 1) of values by nearest rank
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def git_commit() -> str:
+    """
+    Get the commit being measured, marked + if the tree has changes
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ("+" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+######## define classes ########
+
+class StageTimer:
+    """
+    Keep the calls, CPU time (of the calling thread) and wall time of each stage
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def wrap(self, stage: str, function):
+        """
+        Get function timed as stage
+        """
+        def timed(*args, **kwargs):
+            cpu = time.thread_time()
+            wall = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                cpu = time.thread_time() - cpu
+                wall = time.perf_counter() - wall
+                with self.lock:
+                    stats = self.stages.setdefault(stage, {'calls': 0, 'cpu_s': 0.0, 'wall_s': 0.0})
+                    stats['calls'] += 1
+                    stats['cpu_s'] += cpu
+                    stats['wall_s'] += wall
+        return timed
+
+    def report(self) -> dict:
+        return {stage: {'calls': s['calls'], 'cpu_s': round(s['cpu_s'], 4), 'wall_s': round(s['wall_s'], 4)}
+                for stage, s in self.stages.items()}
+
+
+class MemoryBroker:
+    """
+    An in-memory stand-in for the RabbitMQ server: named queues and
+    topic exchanges shared by every connection, with the publish time
+    of each message
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queues = {}
+        # exchange -> (queue, routing key pattern) bindings
+        self.bindings = {}
+        # every published (queue, body, properties), to queue again for the drain pass
+        self.log = []
+        # set once the producer has published its last message
+        self.finished = False
+        # seconds from basic_publish to basic_ack, per message
+        self.latencies = []
+        # queue name -> number of consumers reading it
+        self.consumer_counts = {}
+        # the delivery tags the consumers rejected, dead-lettered by RabbitMQ
+        self.dead_letters = []
+
+    def connect(self, *args, **kwargs):
+        """
+        Open a connection (called like pika.BlockingConnection)
+        """
+        return MemoryConnection(self)
+
+    def put(self, queue_name: str, body: bytes, properties):
+        with self.condition:
+            self.queues.setdefault(queue_name, deque()).append((body, properties, time.perf_counter()))
+            self.log.append((queue_name, body, properties))
+            self.condition.notify_all()
+
+    def route(self, exchange: str, routing_key: str) -> list:
+        """
+        Get the queues a message is routed to, the default exchange
+        routes it to the queue named by the routing key
+        """
+        if not exchange:
+            return [routing_key]
+        with self.condition:
+            bindings = list(self.bindings.get(exchange, []))
+        return [queue_name for queue_name, pattern in bindings if topic_matches(pattern, routing_key)]
+
+    def get(self, queue_names: list, timeout: float):
+        """
+        Take the next message from the first of queue_names that has one,
+        waiting up to timeout seconds
+        Returns:
+            (queue name, body, properties, publish time) or None
+        """
+        with self.condition:
+            deadline = time.monotonic() + timeout
+            while True:
+                for queue_name in queue_names:
+                    pending = self.queues.get(queue_name)
+                    if pending:
+                        return (queue_name,) + pending.popleft()
+                wait = deadline - time.monotonic()
+                if wait <= 0 or self.finished:
+                    return None
+                self.condition.wait(wait)
+
+    def empty(self, queue_names: list) -> bool:
+        with self.condition:
+            return not any(self.queues.get(queue_name) for queue_name in queue_names)
+
+    def finish(self):
+        """
+        Mark the producer as done, consumers stop once their queues are empty
+        """
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+
+class MemoryConnection:
+    """
+    The BlockingConnection methods the producer and consumer use
+    """
+
+    def __init__(self, broker: MemoryBroker):
+        self.broker = broker
+        self.is_open = True
+        # (due time, order, callback) scheduled with call_later
+        self.timers = []
+        self.order = itertools.count()
+        # callbacks handed over from other threads
+        self.callbacks = deque()
+
+    def channel(self):
+        return MemoryChannel(self)
+
+    def add_on_connection_blocked_callback(self, callback):
+        pass
+
+    def add_on_connection_unblocked_callback(self, callback):
+        pass
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def call_later(self, delay: float, callback):
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.order), callback))
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.append(callback)
+
+    def process_events(self) -> float:
+        """
+        Run the handed over callbacks and the timers that are due
+        Returns:
+            the seconds until the next timer
+        """
+        while self.callbacks:
+            self.callbacks.popleft()()
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            heapq.heappop(self.timers)[2]()
+        return self.timers[0][0] - time.monotonic() if self.timers else 0.05
+
+    def close(self):
+        self.is_open = False
+
+
+class MemoryChannel:
+    """
+    The BlockingChannel methods the producer and consumer use.
+    Publishing is always confirmed, and a consumer gets at most
+    prefetch_count unacknowledged messages.
+    """
+
+    def __init__(self, connection: MemoryConnection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.prefetch_count = 0
+        # queue name -> on message callback
+        self.consumers = {}
+        # delivery tag -> publish time, for messages not acknowledged yet
+        self.unacked = {}
+        self.delivery_tags = itertools.count(1)
+        self.consuming = False
+
+    @property
+    def is_open(self):
+        return self.connection.is_open
+
+    def confirm_delivery(self):
+        pass
+
+    def queue_declare(self, queue: str, durable: bool=False, passive: bool=False, **kwargs):
+        with self.broker.condition:
+            pending = self.broker.queues.setdefault(queue, deque())
+            consumer_count = self.broker.consumer_counts.get(queue, 0)
+            return SimpleNamespace(method=SimpleNamespace(queue=queue, message_count=len(pending),
+                                                          consumer_count=consumer_count))
+
+    def queue_delete(self, queue: str):
+        with self.broker.condition:
+            self.broker.queues.pop(queue, None)
+
+    def exchange_declare(self, exchange: str, exchange_type: str="direct", durable: bool=False, **kwargs):
+        with self.broker.condition:
+            self.broker.bindings.setdefault(exchange, [])
+
+    def queue_bind(self, queue: str, exchange: str, routing_key: str=None, **kwargs):
+        with self.broker.condition:
+            bindings = self.broker.bindings.setdefault(exchange, [])
+            if (queue, routing_key) not in bindings:
+                bindings.append((queue, routing_key))
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes, properties=None, mandatory: bool=False):
+        for queue_name in self.broker.route(exchange, routing_key):
+            self.broker.put(queue_name, body, properties)
+
+    def basic_qos(self, prefetch_count: int=0, **kwargs):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue: str, on_message_callback, auto_ack: bool=False, **kwargs):
+        self.consumers[queue] = on_message_callback
+        with self.broker.condition:
+            self.broker.consumer_counts[queue] = self.broker.consumer_counts.get(queue, 0) + 1
+
+    def basic_ack(self, delivery_tag: int=0, multiple: bool=False):
+        now = time.perf_counter()
+        tags = [t for t in self.unacked if t <= delivery_tag] if multiple else [delivery_tag]
+        for tag in tags:
+            self.broker.latencies.append(now - self.unacked.pop(tag))
+
+    def basic_nack(self, delivery_tag: int=0, multiple: bool=False, requeue: bool=True):
+        tags = [t for t in self.unacked if t <= delivery_tag] if multiple else [delivery_tag]
+        for tag in tags:
+            self.unacked.pop(tag)
+            self.broker.dead_letters.append(tag)
+
+    def start_consuming(self):
+        """
+        Deliver messages to the consumers until the producer is done
+        and the consumed queues are empty
+        """
+        self.consuming = True
+        queue_names = list(self.consumers)
+        while self.consuming:
+            wait = self.connection.process_events()
+            if self.prefetch_count and len(self.unacked) >= self.prefetch_count:
+                # the prefetch window is full until messages are acknowledged
+                time.sleep(min(max(wait, 0.0), 0.001))
+                continue
+            message = self.broker.get(queue_names, min(max(wait, 0.0), 0.05))
+            if message is None:
+                if self.broker.finished and self.broker.empty(queue_names):
+                    break
+                continue
+            queue_name, body, properties, published = message
+            delivery_tag = next(self.delivery_tags)
+            self.unacked[delivery_tag] = published
+            method = SimpleNamespace(delivery_tag=delivery_tag, routing_key=queue_name)
+            self.consumers[queue_name](self, method, properties, body)
+        self.connection.process_events()
+
+    def stop_consuming(self):
+        self.consuming = False
+
+    def close(self):
+        pass
+
+
+######## define benchmark functions ########
+
+def reset_consumer(consumer, work_dir: str):
+    """
+    Give the consumer a new store and analytics in work_dir and work
+    there, main opens the output files of each listing in the working folder
+    """
+    from reddit_analytics import TextAnalytics
+    from reddit_store import PostStore
+    os.chdir(work_dir)
+    consumer.post_store = PostStore(os.path.join(work_dir, "reddit_posts.db"))
+    consumer.analytics = TextAnalytics()
+
+def run_consumer(consumer, broker: MemoryBroker, timer: StageTimer, errors: list):
+    """
+    Run Reddit_consumer.main on the in-memory broker with its stages timed
+    """
+    from reddit_alerts import AlertEngine
+    from reddit_analytics import TextAnalytics
+    from reddit_sink import OutputSink
+    from reddit_store import PostStore
+    fake_pika = SimpleNamespace(BlockingConnection=broker.connect,
+                                ConnectionParameters=lambda **kwargs: kwargs)
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(consumer, 'pika', fake_pika))
+        # worker processes need the module level parse_post, so it is
+        # only timed here when it runs in this process
+        if not (consumer.worker_mode and consumer.use_processes):
+            stack.enter_context(mock.patch.object(consumer, 'parse_post', timer.wrap('parse', consumer.parse_post)))
+        for name in ('finish_gap', 'finish_age'):
+            stack.enter_context(mock.patch.object(consumer, name, timer.wrap('finish', getattr(consumer, name))))
+        stack.enter_context(mock.patch.object(OutputSink, 'flush', timer.wrap('write', OutputSink.flush)))
+        stack.enter_context(mock.patch.object(PostStore, 'flush', timer.wrap('write', PostStore.flush)))
+        stack.enter_context(mock.patch.object(AlertEngine, 'observe', timer.wrap('alert', AlertEngine.observe)))
+        stack.enter_context(mock.patch.object(TextAnalytics, 'observe', timer.wrap('analytics', TextAnalytics.observe)))
+        try:
+            consumer.main()
+        except SystemExit as e:
+            if e.code:
+                errors.append(f"consumer exited with {e.code}")
+        except Exception as e:
+            errors.append(f"consumer failed: {e}")
+
+def run_producer(producer, broker: MemoryBroker, stub_url: str, count: int, work_dir: str, timer: StageTimer):
+    """
+    Run Reddit_producer.main against the stub and the in-memory broker
+    with its stages timed
+    """
+    from reddit_client import RedditClient
+    from reddit_publisher import Publisher
+    publisher = Publisher(producer.host, connection_factory=broker.connect)
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.multiple(producer, auth_url=f"{stub_url}/api/v1/access_token",
+                                                api_url=stub_url, post_count=count, poll_mode=False,
+                                                seen_index_path=os.path.join(work_dir, "seen_posts.db"),
+                                                publishers={producer.host: publisher}))
+        # fetch_new_posts takes post_count as its default limit when it is defined
+        fetch_new_posts = producer.fetch_new_posts
+        stack.enter_context(mock.patch.object(producer, 'fetch_new_posts',
+                                              lambda client, page, cursor=None: fetch_new_posts(client, page, cursor, count)))
+        stack.enter_context(mock.patch.object(producer, 'encode_message', timer.wrap('encode', producer.encode_message)))
+        stack.enter_context(mock.patch.object(RedditClient, 'get_posts', timer.wrap('fetch', RedditClient.get_posts)))
+        stack.enter_context(mock.patch.object(Publisher, 'flush', timer.wrap('publish', Publisher.flush)))
+        try:
+            producer.main()
+        finally:
+            publisher.close()
+            broker.finish()
+
+def run_benchmark(count: int=posts_per_listing, text_bytes: int=selftext_bytes, every: int=large_every,
+                  verbose: bool=True) -> dict:
+    """
+    Run the pipeline and drain passes and return the results
+    Parameters:
+        verbose (bool): let the producer and consumer print every message
+    """
+    import Reddit_consumer as consumer
+    import Reddit_producer as producer
+    producer.verbose = consumer.verbose = verbose
+    # the stub accepts any credentials
+    for variable in credential_env.values():
+        os.environ.setdefault(variable, "benchmark")
+    # the messages the consumer could not process, over both passes
+    failed = registry.counter("reddit_messages_failed_total", "Messages that could not be processed")
+    failed_before = failed.value
+
+    producer_timer = StageTimer()
+    consumer_timer = StageTimer()
+    errors = []
+    # the stores, output files and seen index are removed after the run
+    with tempfile.TemporaryDirectory(prefix="reddit_benchmark_") as work_dir, \
+            reddit_stub(count, text_bytes, every) as stub_url, open(os.devnull, "w") as devnull:
+        try:
+            # pass 1: producer and consumer at the same time
+            broker = MemoryBroker()
+            reset_consumer(consumer, work_dir)
+            with contextlib.redirect_stdout(devnull):
+                consumer_thread = threading.Thread(target=run_consumer, args=(consumer, broker, StageTimer(), errors))
+                consumer_thread.start()
+                start = time.perf_counter()
+                run_producer(producer, broker, stub_url, count, work_dir, producer_timer)
+                producer_seconds = time.perf_counter() - start
+                consumer_thread.join()
+            published = len(broker.log)
+            latencies = broker.latencies
+
+            # pass 2: the consumer alone over the same messages, already queued
+            drain = MemoryBroker()
+            for queue_name, body, properties in broker.log:
+                drain.put(queue_name, body, properties)
+            drain.finish()
+            drain_dir = os.path.join(work_dir, "drain")
+            os.makedirs(drain_dir)
+            reset_consumer(consumer, drain_dir)
+            with contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                cpu = time.process_time()
+                run_consumer(consumer, drain, consumer_timer, errors)
+                consumer_seconds = time.perf_counter() - start
+                consumer_cpu = time.process_time() - cpu
+        finally:
+            # leave the folder so it can be removed
+            os.chdir(repo_dir)
+
+    # a message that failed was rejected, not written, so the run is not valid
+    failed_count = int(failed.value - failed_before)
+    if failed_count:
+        errors.append(f"{failed_count} messages could not be processed "
+                      f"({len(broker.dead_letters)} in the pipeline pass, {len(drain.dead_letters)} in the drain pass)")
+
+    return {
+        'time': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'settings': {'posts_per_listing': count, 'selftext_bytes': text_bytes, 'large_every': every,
+                     'verbose': verbose},
+        'producer': {'messages': published, 'seconds': round(producer_seconds, 4),
+                     'bytes': sum(len(body) for _, body, _ in broker.log),
+                     'msgs_per_s': round(published / producer_seconds, 1) if producer_seconds else None},
+        'consumer': {'messages': len(drain.latencies), 'failed': len(drain.dead_letters),
+                     'seconds': round(consumer_seconds, 4),
+                     'cpu_s': round(consumer_cpu, 4),
+                     'msgs_per_s': round(len(drain.latencies) / consumer_seconds, 1) if consumer_seconds else None},
+        'latency_ms': {'messages': len(latencies),
+                       'p50': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+                       'p99': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None},
+        'stages': {**producer_timer.report(), **consumer_timer.report()},
+        'errors': errors,
+    }
+
+def previous_result(settings: dict, path: str=results_path):
+    """
+    Get the last result kept with the same settings (None if there is none)
+    """
+    previous = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as results_file:
+            for line in results_file:
+                result = json.loads(line)
+                if result.get('settings') == settings:
+                    previous = result
+    return previous
+
+def print_report(result: dict, previous: dict=None):
+    """
+    Print the results, with the change from the previous run
+    """
+    def change(section: str, key: str) -> str:
+        if previous is None or not previous[section].get(key) or result[section].get(key) is None:
+            return ""
+        return f"  ({(result[section][key] / previous[section][key] - 1) * 100:+.1f}% vs {previous['commit']})"
+
+    print(f"commit {result['commit']}, {result['settings']}")
+    print(f"producer  {str(result['producer']['msgs_per_s']):>10} msgs/s{change('producer', 'msgs_per_s')}")
+    print(f"          {result['producer']['bytes']:>10} bytes published{change('producer', 'bytes')}")
+    print(f"consumer  {str(result['consumer']['msgs_per_s']):>10} msgs/s{change('consumer', 'msgs_per_s')}")
+    print(f"          {result['consumer']['failed']:>10} messages failed")
+    print(f"latency   {str(result['latency_ms']['p50']):>10} ms p50{change('latency_ms', 'p50')}")
+    print(f"          {str(result['latency_ms']['p99']):>10} ms p99{change('latency_ms', 'p99')}")
+    for stage, stats in result['stages'].items():
+        print(f"{stage:<9} {stats['cpu_s']:>10} s CPU in {stats['calls']} calls ({stats['wall_s']} s wall)")
+    for error in result['errors']:
+        print(f"ERROR: {error}")
+
+# main function to run the program
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the reddit producer and consumer")
+    parser.add_argument("--posts", type=int, default=posts_per_listing, help="posts per listing")
+    parser.add_argument("--selftext-bytes", type=int, default=selftext_bytes, help="size of the large selftext bodies")
+    parser.add_argument("--large-every", type=int, default=large_every, help="give every nth post a large selftext")
+    parser.add_argument("--quiet", action="store_true", help="turn off printing every message")
+    parser.add_argument("--no-save", action="store_true", help="do not append the results to results.jsonl")
+    args = parser.parse_args()
+
+    result = run_benchmark(args.posts, args.selftext_bytes, args.large_every, not args.quiet)
+    print_report(result, previous_result(result['settings']))
+    if not args.no_save:
+        with open(results_path, "a", encoding="utf-8") as results_file:
+            results_file.write(json.dumps(result) + "\n")
+    # a run with errors (e.g. failed messages) is not a valid measurement
+    if result['errors']:
+        sys.exit(1)
+
+
+# Standard Python idiom to indicate main program entry point
+# This allows us to import this module and use its functions
+# without executing the code below.
+# If this is the program being run, then execute the code below
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,295 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module computes windowed metrics for each subreddit as posts
+    arrive and checks them against configurable alert rules.
+
+    Every metric is updated in constant time per post:
+        gap_seconds     - time between this post and the earlier post
+                          (None for the first post)
+        age_seconds     - how long ago the post was created
+        posts_per_hour  - posts in the sliding window (one hour by default),
+                          kept in one bucket per minute
+        window_posts    - posts in the current tumbling window
+        gap_p50/gap_p90 - inter-arrival percentiles for the current tumbling
+                          window, from a fixed histogram of gap sizes
+        score_velocity  - score gained per hour since the post was created
+
+    Alerts are sent to any sink with a send(stream, message, metrics) method.
+'''
+
+######## imports ########
+import json
+import operator
+import time
+
+from reddit_metrics import registry
+
+
+######## declare constants ########
+
+# set the length of the sliding window and of each of its buckets, in seconds
+sliding_window_seconds = 3600
+bucket_seconds = 60
+
+# set the length of the tumbling window, in seconds
+tumbling_window_seconds = 3600
+
+# upper bounds (seconds) of the histogram buckets used for gap percentiles,
+# from one minute doubling up to about 34 days, with one last open bucket
+gap_bounds = [60 * 2 ** i for i in range(16)]
+
+# the comparisons a rule can use
+rule_operators = {'<': operator.lt, '<=': operator.le, '>': operator.gt,
+                  '>=': operator.ge, '==': operator.eq, '!=': operator.ne}
+
+# the metrics a rule can compare and its message can show, see StreamMetrics.update
+metric_names = ('created_utc', 'gap_seconds', 'age_seconds', 'posts_per_hour', 'window_posts',
+                'gap_p50', 'gap_p90', 'score_velocity', 'gap_hours', 'gap_mins', 'age_hours', 'age_mins')
+
+
+######## define classes ########
+
+class SlidingCounter:
+    """
+    Count events in a sliding window with one bucket per interval,
+    so adding an event and reading the count take constant time
+    (events can arrive in any order within the window)
+    Parameters:
+        window_seconds (int): the length of the window
+        bucket_seconds (int): the length of each bucket
+    """
+
+    def __init__(self, window_seconds: int=sliding_window_seconds, bucket_seconds: int=bucket_seconds):
+        self.bucket_seconds = bucket_seconds
+        self.size = max(1, window_seconds // bucket_seconds)
+        # the interval number each bucket holds, and its count
+        self.stamps = [None] * self.size
+        self.counts = [0] * self.size
+
+    def add(self, timestamp: float):
+        """
+        Add an event at timestamp (epoch seconds)
+        """
+        interval = int(timestamp // self.bucket_seconds)
+        slot = interval % self.size
+        if self.stamps[slot] != interval:
+            # the bucket held an older interval, start it over
+            if self.stamps[slot] is not None and self.stamps[slot] > interval:
+                return
+            self.stamps[slot] = interval
+            self.counts[slot] = 0
+        self.counts[slot] += 1
+
+    def count(self, timestamp: float) -> int:
+        """
+        Count the events in the window ending at timestamp
+        """
+        newest = int(timestamp // self.bucket_seconds)
+        oldest = newest - self.size + 1
+        return sum(c for s, c in zip(self.stamps, self.counts) if s is not None and oldest <= s <= newest)
+
+
+class GapHistogram:
+    """
+    A fixed histogram of gap sizes for approximate percentiles
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(gap_bounds) + 1)
+        self.total = 0
+
+    def add(self, seconds: float):
+        """
+        Add a gap, the bucket is found by doubling so it is constant time
+        """
+        index = 0
+        while index < len(gap_bounds) and seconds > gap_bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += 1
+
+    def percentile(self, q: float):
+        """
+        Get the upper bound of the bucket holding the q-th percentile
+        (None when the histogram is empty)
+        Parameters:
+            q (float): the percentile, between 0 and 1
+        """
+        if self.total == 0:
+            return None
+        target = q * self.total
+        running = 0
+        for index, count in enumerate(self.counts):
+            running += count
+            if running >= target and count:
+                return gap_bounds[index] if index < len(gap_bounds) else float('inf')
+        return float('inf')
+
+
+class StreamMetrics:
+    """
+    The windowed metrics of one subreddit
+    Parameters:
+        sliding_seconds (int): the length of the sliding window
+        tumbling_seconds (int): the length of the tumbling window
+    """
+
+    def __init__(self, sliding_seconds: int=sliding_window_seconds, tumbling_seconds: int=tumbling_window_seconds):
+        self.tumbling_seconds = tumbling_seconds
+        self.sliding = SlidingCounter(sliding_seconds)
+        self.previous = None
+        self.window = None
+        self.window_posts = 0
+        self.gaps = GapHistogram()
+
+    def update(self, created_utc: float, score: float=None, now: float=None) -> dict:
+        """
+        Add a post and get the current metrics
+        Parameters:
+            created_utc (float): when the post was created, in epoch seconds
+            score (float): the score of the post
+            now (float): the current time (defaults to time.time())
+        """
+        now = time.time() if now is None else now
+
+        # time between this post and the earlier post (None for the first post)
+        gap = abs(self.previous - created_utc) if self.previous is not None else None
+        self.previous = created_utc
+
+        # start a new tumbling window when the post falls in a later one
+        window = int(created_utc // self.tumbling_seconds)
+        if self.window is None or window > self.window:
+            self.window = window
+            self.window_posts = 0
+            self.gaps = GapHistogram()
+        self.window_posts += 1
+        if gap is not None:
+            self.gaps.add(gap)
+
+        self.sliding.add(created_utc)
+        age = now - created_utc
+
+        metrics = {
+            'created_utc': created_utc,
+            'gap_seconds': gap,
+            'age_seconds': age,
+            'posts_per_hour': self.sliding.count(created_utc) * 3600 / (self.sliding.size * self.sliding.bucket_seconds),
+            'window_posts': self.window_posts,
+            'gap_p50': self.gaps.percentile(0.5),
+            'gap_p90': self.gaps.percentile(0.9),
+            'score_velocity': score / max(age / 3600, 1 / 60) if score is not None else None,
+        }
+        # whole hours and remaining minutes, as shown in the output files
+        for name in ('gap', 'age'):
+            seconds = metrics[f'{name}_seconds']
+            hours = int(seconds // 3600) if seconds is not None else None
+            metrics[f'{name}_hours'] = hours
+            metrics[f'{name}_mins'] = int((seconds - hours * 3600) // 60) if seconds is not None else None
+        return metrics
+
+
+class Rule:
+    """
+    An alert rule that compares one metric to a threshold
+    Parameters:
+        metric (str): the metric name, e.g. gap_hours
+        op (str): the comparison, one of <, <=, >, >=, ==, !=
+        threshold (float): the value to compare the metric to
+        message (str): the alert message, formatted with the metrics
+    The metric and the names in the message are checked here, so a
+    misspelled one stops the consumer at startup, not on every post.
+    """
+
+    def __init__(self, metric: str, op: str, threshold: float, message: str):
+        if op not in rule_operators:
+            raise ValueError(f"op must be one of {list(rule_operators)}")
+        if metric not in metric_names:
+            raise ValueError(f"metric must be one of {list(metric_names)}, not {metric!r}")
+        try:
+            message.format(**dict.fromkeys(metric_names, 0))
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"alert message {message!r} can only use the metrics {list(metric_names)}: {e!r}")
+        self.metric = metric
+        self.op = op
+        self.threshold = threshold
+        self.message = message
+
+    @classmethod
+    def from_dict(cls, rule: dict):
+        """
+        Create a rule from its settings
+        Parameters:
+            rule (dict): with keys metric, op, threshold and message
+        """
+        return cls(rule['metric'], rule['op'], rule['threshold'], rule['message'])
+
+    def check(self, metrics: dict):
+        """
+        Get the alert message if the rule matches, otherwise None
+        """
+        value = metrics.get(self.metric)
+        if value is not None and rule_operators[self.op](value, self.threshold):
+            return self.message.format(**metrics)
+        return None
+
+
+class PrintAlertSink:
+    """
+    Print alerts to the console
+    """
+
+    def send(self, stream: str, message: str, metrics: dict):
+        print(f" >>>>>>>> ALERT: {message}")
+
+
+class FileAlertSink:
+    """
+    Append alerts to a file, one JSON object per line
+    Parameters:
+        path (str): the alert file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def send(self, stream: str, message: str, metrics: dict):
+        with open(self.path, "a", encoding="utf-8") as alert_file:
+            alert_file.write(json.dumps({'time': time.time(), 'stream': stream,
+                                         'message': message, 'metrics': metrics}) + "\n")
+
+
+class AlertEngine:
+    """
+    Keep the metrics of each subreddit and send alerts when rules match
+    Parameters:
+        rules (dict): the rule settings (dicts) for each subreddit
+        sinks (list): where to send alerts (defaults to printing them)
+    """
+
+    def __init__(self, rules: dict, sinks: list=None):
+        self.rules = {stream: [Rule.from_dict(r) for r in stream_rules] for stream, stream_rules in rules.items()}
+        self.sinks = sinks if sinks is not None else [PrintAlertSink()]
+        self.streams = {}
+
+    def observe(self, stream: str, created_utc: float, score: float=None, now: float=None) -> dict:
+        """
+        Add a post to its subreddit's metrics, send any alerts
+        and return the metrics
+        Parameters:
+            stream (str): the subreddit (or other stream name)
+            created_utc (float): when the post was created, in epoch seconds
+            score (float): the score of the post
+            now (float): the current time (defaults to time.time())
+        """
+        with registry.timer("alert"):
+            if stream not in self.streams:
+                self.streams[stream] = StreamMetrics()
+            metrics = self.streams[stream].update(created_utc, score, now)
+            for rule in self.rules.get(stream, []):
+                message = rule.check(metrics)
+                if message is not None:
+                    registry.counter("reddit_alerts_total", "Alerts sent", stream=stream).inc()
+                    for sink in self.sinks:
+                        sink.send(stream, message, metrics)
+            return metrics
@@ -0,0 +1,273 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module finds the trending terms and flair of each listing per
+    time window in fixed memory, however large the vocabulary grows on
+    a long-running consumer.
+
+    Each window keeps a Count-Min Sketch (a depth x width table of
+    counters) that estimates how many posts used any term, never below
+    the true count and at most about total / width above it with high
+    probability, and a Space-Saving list of the top_k terms with the
+    highest estimates. Flair is counted the same way.
+
+    Windows are tumbling windows of created_utc (event time), and only
+    the most recent keep_windows windows of each listing are kept.
+    The terms of a post are found once, when it is cleaned
+    (see tokenize in reddit_cleaner.py), and each term is counted once
+    per post. The results can be queried, or written to a JSON snapshot
+    file periodically.
+'''
+
+######## imports ########
+import heapq
+import json
+import os
+import time
+from array import array
+
+from reddit_metrics import registry
+
+
+######## declare constants ########
+
+# set the size of each Count-Min Sketch: more columns (width) give
+# smaller overestimates, more rows (depth) make a large one less likely
+sketch_width = 2048
+sketch_depth = 4
+
+# set how many trending terms and flair to keep per window
+top_k = 50
+top_flair = 10
+
+# set the length of each window, in seconds
+window_seconds = 3600
+
+# set how many of the most recent windows to keep per listing
+keep_windows = 24
+
+# set how many seconds to wait between snapshot files
+snapshot_interval = 60
+
+
+######## define classes ########
+
+class CountMinSketch:
+    """
+    Estimate the count of any key in fixed memory
+    Parameters:
+        width (int): the counters per row
+        depth (int): the rows, each with its own hash
+    """
+
+    def __init__(self, width: int=sketch_width, depth: int=sketch_depth):
+        self.width = width
+        self.depth = depth
+        self.counts = array('Q', bytes(8 * width * depth))
+        self.total = 0
+
+    def cells(self, key: str) -> list:
+        """
+        Get the counter of the key in each row, from the two halves of
+        its hash (the sketch is only kept in memory, so the hash does
+        not need to be the same in another process)
+        """
+        key_hash = hash(key)
+        first = key_hash & 0xFFFFFFFF
+        second = (key_hash >> 32 & 0xFFFFFFFF) | 1
+        width = self.width
+        return [row * width + (first + row * second) % width for row in range(self.depth)]
+
+    def add(self, key: str, count: int=1) -> int:
+        """
+        Count a key and get its new estimate
+        """
+        self.total += count
+        counts = self.counts
+        estimate = None
+        for cell in self.cells(key):
+            counts[cell] += count
+            if estimate is None or counts[cell] < estimate:
+                estimate = counts[cell]
+        return estimate
+
+    def estimate(self, key: str) -> int:
+        return min(self.counts[cell] for cell in self.cells(key))
+
+
+class SpaceSaving:
+    """
+    Keep the k keys with the highest counts, in fixed memory.
+    A key that is not kept replaces the lowest kept key when its
+    count (from the sketch) is higher.
+    Parameters:
+        k (int): the number of keys to keep
+    """
+
+    def __init__(self, k: int=top_k):
+        self.k = k
+        self.counts = {}
+        # (count, key) of the kept keys, with stale entries removed lazily
+        self.heap = []
+
+    def update(self, key: str, count: int):
+        """
+        Set the estimated count of a key, keeping it if it is in the top k
+        """
+        if key not in self.counts:
+            if len(self.counts) >= self.k:
+                lowest = self.lowest()
+                if count <= self.counts[lowest]:
+                    return
+                del self.counts[lowest]
+        self.counts[key] = count
+        heapq.heappush(self.heap, (count, key))
+        # drop the stale entries once the heap is much larger than k
+        if len(self.heap) > 4 * self.k:
+            self.heap = [(kept_count, kept_key) for kept_key, kept_count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def lowest(self) -> str:
+        """
+        Get the kept key with the lowest count
+        """
+        while True:
+            count, key = self.heap[0]
+            if self.counts.get(key) == count:
+                return key
+            heapq.heappop(self.heap)
+
+    def top(self, n: int=None) -> list:
+        """
+        Get the (key, count) of the n keys with the highest counts
+        """
+        ranked = sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+        return ranked if n is None else ranked[:n]
+
+
+class HeavyHitters:
+    """
+    The top keys of one window: a Count-Min Sketch of every key
+    and a Space-Saving list of the highest ones
+    """
+
+    def __init__(self, k: int, width: int=sketch_width, depth: int=sketch_depth):
+        self.sketch = CountMinSketch(width, depth)
+        self.top = SpaceSaving(k)
+
+    def add(self, key: str):
+        self.top.update(key, self.sketch.add(key))
+
+
+class Window:
+    """
+    The trending terms and flair of one listing in one window
+    Parameters:
+        start (int): when the window starts, in epoch seconds
+    """
+
+    def __init__(self, start: int):
+        self.start = start
+        self.posts = 0
+        self.terms = HeavyHitters(top_k)
+        self.flair = HeavyHitters(top_flair, width=256)
+
+    def summary(self, n: int=None) -> dict:
+        return {
+            'start': self.start,
+            'posts': self.posts,
+            'terms': self.terms.top.top(n),
+            'flair': self.flair.top.top(n),
+        }
+
+
+class TextAnalytics:
+    """
+    Keep the trending terms and flair of each listing per window
+    Parameters:
+        window_seconds (int): the length of each window
+        keep_windows (int): the most recent windows to keep per listing
+    """
+
+    def __init__(self, window_seconds: int=window_seconds, keep_windows: int=keep_windows):
+        self.window_seconds = window_seconds
+        self.keep_windows = keep_windows
+        # stream -> {window start: Window}
+        self.streams = {}
+        self.last_snapshot = time.monotonic()
+
+    def observe(self, stream: str, created_utc: float, terms: list, flair: str=None):
+        """
+        Count the terms and flair of a post
+        Parameters:
+            stream (str): the listing name
+            created_utc (float): when the post was created, in epoch seconds
+            terms (list): the distinct terms of the post, see tokenize
+            flair (str): the flair of the post
+        """
+        with registry.timer("analytics"):
+            windows = self.streams.setdefault(stream, {})
+            start = int(created_utc // self.window_seconds * self.window_seconds)
+            window = windows.get(start)
+            if window is None:
+                # a post older than every kept window is not counted
+                if len(windows) >= self.keep_windows and start < min(windows):
+                    registry.counter("reddit_analytics_dropped_total",
+                                     "Posts older than every kept analytics window").inc()
+                    return
+                window = windows[start] = Window(start)
+                while len(windows) > self.keep_windows:
+                    del windows[min(windows)]
+            window.posts += 1
+            for term in terms:
+                window.terms.add(term)
+            if flair:
+                window.flair.add(flair)
+
+    def top_terms(self, stream: str, n: int=10, start: int=None) -> list:
+        """
+        Get the (term, estimated posts) of the n trending terms of a listing
+        Parameters:
+            stream (str): the listing name
+            n (int): the number of terms
+            start (int): the window start (None = the latest window)
+        """
+        window = self.window(stream, start)
+        return window.terms.top.top(n) if window is not None else []
+
+    def top_flair(self, stream: str, n: int=10, start: int=None) -> list:
+        """
+        Get the (flair, estimated posts) of the n most used flair of a listing
+        """
+        window = self.window(stream, start)
+        return window.flair.top.top(n) if window is not None else []
+
+    def window(self, stream: str, start: int=None):
+        windows = self.streams.get(stream, {})
+        if not windows:
+            return None
+        return windows.get(max(windows) if start is None else start)
+
+    def snapshot(self, n: int=10) -> dict:
+        """
+        Get the top n terms and flair of every kept window of every listing
+        """
+        return {stream: [windows[start].summary(n) for start in sorted(windows)]
+                for stream, windows in self.streams.items()}
+
+    def write_snapshot(self, path: str, n: int=10):
+        """
+        Write the snapshot to a JSON file, replacing it in one step
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as snapshot_file:
+            json.dump({'time': time.time(), 'streams': self.snapshot(n)}, snapshot_file, indent=4)
+        os.replace(temp_path, path)
+        self.last_snapshot = time.monotonic()
+
+    def maybe_write_snapshot(self, path: str, interval: float=snapshot_interval, n: int=10):
+        """
+        Write the snapshot if it has not been written for interval seconds
+        """
+        if time.monotonic() - self.last_snapshot >= interval:
+            self.write_snapshot(path, n)
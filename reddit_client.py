@@ -0,0 +1,284 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module is the reddit API client shared by the producer and
+    reddit_api_base.py. It keeps a pool of keep-alive connections,
+    caches the OAuth token and requests a new one before it expires,
+    retries with a growing wait when reddit answers 429 or 5xx,
+    and turns a listing response into a Listing of Post records.
+
+    Reddit API Base Code Source:
+    - Link https://towardsdatascience.com/how-to-use-the-reddit-api-in-python-5e05ddfd1e5c
+'''
+
+######## imports ########
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from reddit_metrics import registry
+
+
+######## declare constants ########
+
+# set the reddit authentication url
+auth_url = "https://www.reddit.com/api/v1/access_token"
+
+# set how many seconds before the token expires to request a new one
+token_refresh_margin = 60
+
+# set how many times to retry a request that failed with 429 or 5xx,
+# and the wait before the first retry (doubled after each retry)
+max_retries = 3
+retry_backoff = 1.0
+
+# set how many keep-alive connections to keep open
+pool_size = 10
+
+# set how many seconds to wait for reddit to answer
+request_timeout = 30
+
+
+######## define functions ########
+
+def posts_from_json(listing: dict) -> 'Listing':
+    '''
+    Convert a listing response to a Listing of posts
+    with created_utc in epoch seconds
+    Parameters:
+        listing (dict): the json of a listing response
+    '''
+    return Listing([Post.from_json(child) for child in listing['data']['children']])
+
+def posts_from_response(res) -> 'Listing':
+    '''
+    Convert the response for a listing to a Listing of posts
+    Parameters:
+        res: the response of a listing request
+    '''
+    return posts_from_json(res.json())
+
+
+######## define classes ########
+
+class Post:
+    """
+    One reddit post with the fields the producer passes through.
+    __slots__ keeps each post small and its fields fast to read.
+    """
+
+    # the post fields, in the order of a listing row
+    fields = ('subreddit', 'title', 'selftext', 'upvote_ratio', 'ups', 'downs',
+              'score', 'link_flair_css_class', 'created_utc', 'id', 'kind')
+    __slots__ = fields
+
+    def __init__(self, subreddit, title, selftext, upvote_ratio, ups, downs,
+                 score, link_flair_css_class, created_utc, id, kind):
+        self.subreddit = subreddit
+        self.title = title
+        self.selftext = selftext
+        self.upvote_ratio = upvote_ratio
+        self.ups = ups
+        self.downs = downs
+        self.score = score
+        self.link_flair_css_class = link_flair_css_class
+        self.created_utc = created_utc
+        self.id = id
+        self.kind = kind
+
+    @classmethod
+    def from_json(cls, child: dict):
+        """
+        Create a post from one child of a listing response,
+        with created_utc in epoch seconds
+        Parameters:
+            child (dict): the json of one post in the listing
+        """
+        post = child['data']
+        return cls(post['subreddit'], post['title'], post['selftext'], post['upvote_ratio'],
+                   post['ups'], post['downs'], post['score'], post['link_flair_css_class'],
+                   int(post['created_utc']), post['id'], child['kind'])
+
+    @property
+    def fullname(self) -> str:
+        """
+        The reddit fullname (kind_id) of the post, used as the
+        'after' / 'before' cursor when paging a listing
+        """
+        return self.kind + '_' + self.id
+
+    def to_dict(self) -> dict:
+        """
+        Get the post fields as a dictionary
+        """
+        return {field: getattr(self, field) for field in self.fields}
+
+
+class Listing:
+    """
+    The posts of one or more listing pages, in listing order
+    Parameters:
+        posts (list): the posts
+    """
+
+    __slots__ = ('posts',)
+
+    def __init__(self, posts: list=None):
+        self.posts = posts if posts is not None else []
+
+    def __iter__(self):
+        return iter(self.posts)
+
+    def __len__(self):
+        return len(self.posts)
+
+    def __getitem__(self, index):
+        return self.posts[index]
+
+    def to_dicts(self) -> list:
+        """
+        Get the posts as a list of dictionaries
+        """
+        return [post.to_dict() for post in self.posts]
+
+    def to_dataframe(self):
+        """
+        Build a dataframe of the posts for analytics,
+        pandas is only imported when this is called
+        """
+        import pandas as pd
+        return pd.DataFrame.from_records([[getattr(post, field) for field in Post.fields] for post in self.posts],
+                                         columns=list(Post.fields))
+
+
+class RedditClient:
+    """
+    A reddit API client that reuses connections and its OAuth token
+    Parameters:
+        username (str): reddit.com username
+        password (str): reddit.com password
+        app_name (str): name of reddit.com api application (the User-Agent)
+        client_id (str): the personal use script of the application
+        client_secret (str): the secret token of the application
+        auth_url (str): the url to request the OAuth token from
+        limiter (RateLimiter): the shared rate budget (None = no limit)
+    """
+
+    def __init__(self, username: str, password: str, app_name: str, client_id: str,
+                 client_secret: str, auth_url: str=auth_url, limiter=None):
+        self.username = username
+        self.password = password
+        self.client_auth = requests.auth.HTTPBasicAuth(client_id, client_secret)
+        self.auth_url = auth_url
+        self.limiter = limiter
+
+        # keep a pool of keep-alive connections so each request
+        # does not need a new TLS handshake
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['User-Agent'] = app_name
+
+        # the cached token and when it expires
+        self.token = None
+        self.token_expires = 0.0
+        self.token_lock = threading.Lock()
+
+    def authorization(self, force_refresh: bool=False) -> str:
+        """
+        Get the bearer token, requesting a new one if there is none
+        or it expires within token_refresh_margin seconds
+        Parameters:
+            force_refresh (bool): request a new token even if it has not expired
+        """
+        with self.token_lock:
+            if force_refresh or self.token is None or time.monotonic() >= self.token_expires - token_refresh_margin:
+                self.refresh_token()
+            return self.token
+
+    def refresh_token(self):
+        """
+        Request an OAuth token with the password grant
+        """
+        data = {
+            'grant_type': 'password',
+            'username': self.username,
+            'password': self.password
+        }
+        # send authentication request for OAuth token
+        res = self.send(self.session.post, self.auth_url, auth=self.client_auth, data=data)
+        res.raise_for_status()
+        body = res.json()
+        # extract token from response and format correctly
+        self.token = f"bearer {body['access_token']}"
+        self.token_expires = time.monotonic() + float(body.get('expires_in', 3600))
+
+    def send(self, method, url: str, limited: bool=False, **kwargs):
+        """
+        Send a request, retrying with a growing wait when reddit
+        answers 429 or 5xx or the connection fails
+        Parameters:
+            method: the session method, e.g. self.session.get
+            url (str): the url to request
+            limited (bool): count every attempt against the rate budget
+            kwargs: passed to the method
+        """
+        kwargs.setdefault('timeout', request_timeout)
+        for attempt in range(max_retries + 1):
+            try:
+                if limited and self.limiter is not None:
+                    res = self.limiter.request(method, url, **kwargs)
+                else:
+                    res = method(url, **kwargs)
+            except requests.ConnectionError:
+                if attempt == max_retries:
+                    raise
+                time.sleep(retry_backoff * 2 ** attempt)
+                continue
+            registry.counter("reddit_http_responses_total", "Responses from the reddit api",
+                             status=str(res.status_code)).inc()
+            if res.status_code == 429 or res.status_code >= 500:
+                if attempt == max_retries:
+                    res.raise_for_status()
+                # wait as long as reddit asks, otherwise back off
+                wait = res.headers.get('Retry-After')
+                time.sleep(float(wait) if wait else retry_backoff * 2 ** attempt)
+                continue
+            return res
+
+    def get(self, url: str, params: dict=None):
+        """
+        Send an authorized GET request within the rate budget
+        Parameters:
+            url (str): the api url to request
+            params (dict): the query parameters
+        """
+        force_refresh = False
+        with registry.timer("fetch"):
+            while True:
+                headers = {'Authorization': self.authorization(force_refresh)}
+                res = self.send(self.session.get, url, limited=True, headers=headers, params=params)
+                # a token that was revoked early is requested again once
+                if res.status_code == 401 and not force_refresh:
+                    force_refresh = True
+                    continue
+                res.raise_for_status()
+                return res
+
+    def get_posts(self, url: str, params: dict=None) -> Listing:
+        """
+        Request a listing and return its posts
+        Parameters:
+            url (str): the listing url
+            params (dict): the query parameters, e.g. limit, after, before
+        """
+        return posts_from_response(self.get(url, params))
+
+    def close(self):
+        """
+        Close the pooled connections
+        """
+        self.session.close()
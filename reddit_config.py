@@ -0,0 +1,270 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module reads the listings the producer polls and the consumer
+    processes from a JSON file (reddit_config.json), so subreddits can
+    be added without changing the code.
+
+    Each listing is published to a topic exchange with the routing key
+        reddit.<subreddit>.<listing>
+    and routed into its own durable queue. A consumer handles the
+    listings whose routing key matches its pattern (* matches one word,
+    # any number of words), split into shards when several consumers
+    share the listings. Each listing stays on one consumer, so its
+    posts are still processed in order.
+
+    Transforms:
+        gap - posts are put back in created_utc order and the time
+              since the earlier post is written (r/dataanalysis/new)
+        age - how long ago the post was created is written
+              (r/todayilearned/top)
+
+    The producer only pages from the newest post it has published on a
+    time-ordered listing (new). A ranked listing (top, hot, ...) is
+    fetched from the top every cycle and the posts already published
+    are skipped, since a new post can enter it below the first one.
+    Set "cursor_paging" on a listing to choose.
+
+    When the file is missing, the two original listings and queues are used.
+
+    A message the consumer cannot process is rejected and the broker
+    moves it, through the dead-letter exchange set on every listing
+    queue, to one durable dead-letter queue (reddit_dead_letter_queue)
+    to be looked at and published again. A queue declared by an
+    earlier version without the dead-letter exchange is used as it is,
+    with a warning, keeping its messages. Give it the dead-letter
+    exchange with a RabbitMQ policy, e.g.
+        rabbitmqctl set_policy reddit-dead-letter "^(dataanalysis|todayilearned)_queue$" \
+            '{"dead-letter-exchange":"reddit.dead_letter"}' --apply-to queues
+
+    It also reads the reddit login credentials, from environment
+    variables or from the credentials file:
+        REDDIT_USERNAME, REDDIT_PASSWORD, REDDIT_APP_NAME,
+        REDDIT_PERSONAL_USE_SCRIPT, REDDIT_SECRET_TOKEN
+    The file (reddit_login_credentials.txt, or REDDIT_CREDENTIALS_FILE)
+    has a header line, then one value per line in the order above.
+    A variable that is set takes the place of the line in the file.
+
+    Both are read the first time they are needed, not on import,
+    and kept for the life of the process.
+'''
+
+######## imports ########
+import csv
+import functools
+import json
+import os
+import zlib
+from collections import namedtuple
+from urllib.parse import urlencode
+
+
+######## declare constants ########
+
+# set the configuration file
+config_path = "reddit_config.json"
+
+# set the topic exchange the listings are published to
+exchange_name = "reddit"
+
+# set the exchange and queue the messages the consumer rejects are moved to
+dead_letter_exchange = "reddit.dead_letter"
+dead_letter_queue = "reddit_dead_letter_queue"
+
+# the transforms a listing can use
+transforms = ("gap", "age")
+
+# the listings sorted newest first, which can be paged from a cursor
+time_ordered = ("new",)
+
+# set the reddit login credentials file
+credentials_path = "reddit_login_credentials.txt"
+
+# the credentials in the order of the file, and the variable for each
+credential_fields = ("username", "password", "dev_app_name", "personal_use_script", "secret_token")
+credential_env = {"username": "REDDIT_USERNAME", "password": "REDDIT_PASSWORD",
+                  "dev_app_name": "REDDIT_APP_NAME", "personal_use_script": "REDDIT_PERSONAL_USE_SCRIPT",
+                  "secret_token": "REDDIT_SECRET_TOKEN"}
+
+# the reddit login credentials
+Credentials = namedtuple("Credentials", credential_fields)
+
+# the listings used when there is no configuration file
+default_config = {
+    "exchange": exchange_name,
+    "listings": [
+        {"subreddit": "dataanalysis", "listing": "new", "queue": "dataanalysis_queue",
+         "transform": "gap",
+         "alerts": [
+             {"metric": "gap_hours", "op": "<", "threshold": 1,
+              "message": "< 1 Hour Between Posts ({gap_hours} hr. {gap_mins} min.)"},
+             {"metric": "gap_hours", "op": ">", "threshold": 4,
+              "message": "> 4 Hours Between Posts ({gap_hours} hr. {gap_mins} min.)"}]},
+        {"subreddit": "todayilearned", "listing": "top", "params": {"t": "day"},
+         "queue": "todayilearned_queue", "transform": "age",
+         "alerts": [
+             {"metric": "age_hours", "op": "<", "threshold": 1,
+              "message": "Posted < 1 Hour Ago ({age_hours} hr. {age_mins} min.)"},
+             {"metric": "age_hours", "op": ">", "threshold": 5,
+              "message": "Posted > 5 Hours Ago ({age_hours} hr. {age_mins} min.)"}]},
+    ],
+}
+
+
+######## define functions ########
+
+@functools.lru_cache(maxsize=None)
+def load_config(path: str=config_path) -> dict:
+    """
+    Read the configuration file, or use the default listings if it is missing.
+    The file is only read once per path.
+    Parameters:
+        path (str): the configuration file
+    Returns:
+        a dictionary with the exchange name, the dead-letter exchange
+        and queue names and a list of ListingConfig
+    """
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as config_file:
+            config = json.load(config_file)
+    else:
+        config = default_config
+    listings = [ListingConfig.from_dict(listing) for listing in config.get("listings", [])]
+    names = [listing.name for listing in listings]
+    if len(set(names)) != len(names):
+        raise ValueError("each subreddit and listing can only be configured once")
+    return {"exchange": config.get("exchange", exchange_name),
+            "dead_letter_exchange": config.get("dead_letter_exchange", dead_letter_exchange),
+            "dead_letter_queue": config.get("dead_letter_queue", dead_letter_queue),
+            "listings": listings}
+
+def queue_arguments(config: dict) -> dict:
+    """
+    Get the arguments every listing queue is declared with, the producer
+    and consumer must declare a queue with the same arguments
+    Parameters:
+        config (dict): the configuration, see load_config
+    """
+    return {"x-dead-letter-exchange": config["dead_letter_exchange"]}
+
+@functools.lru_cache(maxsize=None)
+def load_credentials(path: str=None) -> Credentials:
+    """
+    Read the reddit login credentials from the environment variables,
+    then the credentials file for any that are not set.
+    The credentials are only read once.
+    Parameters:
+        path (str): the credentials file (None = REDDIT_CREDENTIALS_FILE or credentials_path)
+    """
+    values = {field: os.environ.get(credential_env[field]) for field in credential_fields}
+    if not all(values.values()):
+        path = path or os.environ.get("REDDIT_CREDENTIALS_FILE", credentials_path)
+        try:
+            with open(path, encoding="utf-8", newline="") as credentials_file:
+                # skip the header line and any blank lines
+                rows = [row for row in csv.reader(credentials_file) if row][1:]
+        except FileNotFoundError:
+            rows = []
+        for field, row in zip(credential_fields, rows):
+            values[field] = values[field] or row[0].strip()
+    missing = [credential_env[field] for field in credential_fields if not values[field]]
+    if missing:
+        raise ValueError(f"reddit credentials missing: set {', '.join(missing)} or write them to {path}")
+    return Credentials(**values)
+
+def topic_matches(pattern: str, routing_key: str) -> bool:
+    """
+    Check a routing key against a topic pattern, as the broker does:
+    * matches exactly one word and # matches zero or more words
+    """
+    def match(words: list, keys: list) -> bool:
+        if not words:
+            return not keys
+        if words[0] == "#":
+            return any(match(words[1:], keys[i:]) for i in range(len(keys) + 1))
+        return bool(keys) and words[0] in ("*", keys[0]) and match(words[1:], keys[1:])
+    return match(pattern.split("."), routing_key.split("."))
+
+def shard_of(name: str, shard_count: int) -> int:
+    """
+    Get the shard of a listing, the same on every machine
+    """
+    return zlib.crc32(name.encode("utf-8")) % shard_count
+
+def select_listings(listings: list, pattern: str="reddit.#", shard_index: int=0, shard_count: int=1) -> list:
+    """
+    Get the listings a consumer handles
+    Parameters:
+        listings (list): the configured listings
+        pattern (str): the routing key pattern to handle
+        shard_index (int): this consumer's shard, from 0 to shard_count - 1
+        shard_count (int): the number of consumers sharing the listings
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError("shard_index must be between 0 and shard_count - 1")
+    return [listing for listing in listings
+            if topic_matches(pattern, listing.routing_key) and shard_of(listing.name, shard_count) == shard_index]
+
+
+######## define classes ########
+
+class ListingConfig:
+    """
+    The settings of one subreddit listing
+    Parameters:
+        subreddit (str): the subreddit, e.g. dataanalysis
+        listing (str): the listing, e.g. new or top
+        params (dict): extra query parameters, e.g. {"t": "day"}
+        queue (str): the durable queue the listing is routed into
+        transform (str): "gap" or "age", see above
+        output (str): the consumer's output file
+        late_output (str): the output file for late posts (gap transform)
+        alerts (list): the alert rules, see reddit_alerts.py
+        cursor_paging (bool): page from the newest published post (None = only for new)
+    """
+
+    __slots__ = ('subreddit', 'listing', 'params', 'queue', 'transform', 'output', 'late_output', 'alerts',
+                 'cursor_paging')
+
+    def __init__(self, subreddit: str, listing: str="new", params: dict=None, queue: str=None,
+                 transform: str="gap", output: str=None, late_output: str=None, alerts: list=None,
+                 cursor_paging: bool=None):
+        if transform not in transforms:
+            raise ValueError(f"transform must be one of {transforms}")
+        self.subreddit = subreddit
+        self.listing = listing
+        self.params = params or {}
+        self.queue = queue or f"{subreddit}_{listing}_queue"
+        self.transform = transform
+        self.output = output or f"output_{subreddit}.txt"
+        self.late_output = late_output or f"output_{subreddit}_late.txt"
+        self.alerts = alerts or []
+        self.cursor_paging = listing in time_ordered if cursor_paging is None else cursor_paging
+
+    @classmethod
+    def from_dict(cls, listing: dict):
+        """
+        Create a listing from its settings in the configuration file
+        """
+        return cls(**listing)
+
+    @property
+    def name(self) -> str:
+        """
+        The subreddit and listing, e.g. dataanalysis.new
+        """
+        return f"{self.subreddit}.{self.listing}"
+
+    @property
+    def routing_key(self) -> str:
+        """
+        The routing key the listing is published with
+        """
+        return f"reddit.{self.name}"
+
+    def url(self, api_url: str) -> str:
+        """
+        The listing url on the reddit api
+        """
+        query = f"?{urlencode(self.params)}" if self.params else ""
+        return f"{api_url}/r/{self.subreddit}/{self.listing}/{query}"
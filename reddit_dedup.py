@@ -0,0 +1,91 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module remembers which posts the producer has already
+    published, in a small SQLite file, so a restarted producer and
+    listings that return the same posts every cycle (such as
+    r/todayilearned/top/?t=day) do not publish a post twice.
+
+    Entries older than the time to live are removed, and the
+    index never holds more than max_entries posts.
+'''
+
+######## imports ########
+import sqlite3
+import time
+
+
+######## declare constants ########
+
+# set the file the published post ids are kept in
+index_path = "seen_posts.db"
+
+# set how many seconds a post id is remembered (7 days)
+ttl_seconds = 7 * 24 * 3600
+
+# set the largest number of post ids to remember
+max_entries = 100000
+
+
+######## define classes ########
+
+class SeenIndex:
+    """
+    A bounded, persistent set of published post ids
+    Parameters:
+        path (str): the SQLite file
+        ttl_seconds (float): how long a post id is remembered
+        max_entries (int): the largest number of post ids to remember
+    """
+
+    def __init__(self, path: str=index_path, ttl_seconds: float=ttl_seconds, max_entries: int=max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path)
+        # write-ahead logging keeps each commit to a single append
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS seen_at_index ON seen (seen_at)")
+        self.connection.commit()
+
+    def unseen(self, ids: list) -> set:
+        """
+        Get the post ids that have not been published yet
+        Parameters:
+            ids (list): the post ids to check
+        """
+        ids = list(ids)
+        if not ids:
+            return set()
+        cutoff = time.time() - self.ttl_seconds
+        seen = set()
+        # check the ids in chunks to stay under sqlite's parameter limit
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT id FROM seen WHERE id IN ({placeholders}) AND seen_at >= ?", (*chunk, cutoff))
+            seen.update(row[0] for row in rows)
+        return set(ids) - seen
+
+    def add(self, ids: list):
+        """
+        Remember post ids once they are published, then remove
+        expired entries and the oldest entries over the limit
+        Parameters:
+            ids (list): the published post ids
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO seen (id, seen_at) VALUES (?, ?)",
+                                        [(post_id, now) for post_id in ids])
+            self.connection.execute("DELETE FROM seen WHERE seen_at < ?", (now - self.ttl_seconds,))
+            self.connection.execute(
+                "DELETE FROM seen WHERE id IN (SELECT id FROM seen ORDER BY seen_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
+
+    def close(self):
+        """
+        Close the SQLite file
+        """
+        self.connection.close()
@@ -0,0 +1,115 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module puts posts back in created_utc (event time) order
+    before the consumer computes the time between posts.
+
+    Posts are held in a small buffer and released in created_utc
+    order once the watermark passes them. The watermark trails the
+    newest created_utc seen by the allowed lateness. A post that
+    arrives after the watermark has already passed it is late: it is
+    counted and handed back to the caller for a side output instead
+    of being mixed into the metrics out of order.
+
+    Memory stays bounded: a post is released once it has waited
+    max_delay seconds, or when the buffer holds max_events posts.
+'''
+
+######## imports ########
+import heapq
+import itertools
+import time
+
+
+######## declare constants ########
+
+# set how many seconds of created_utc a post may trail the newest post
+allowed_lateness = 600
+
+# set the longest a post may wait in the buffer, in seconds of wall time,
+# so posts are still released when no newer posts arrive
+max_delay = 30
+
+# set the most posts to hold in the buffer. Held posts are not acknowledged,
+# so the consumer lowers this to fit every buffer in its prefetch_count
+max_events = 50
+
+
+######## define classes ########
+
+class ReorderBuffer:
+    """
+    Hold events and release them in event time order
+    once the watermark passes them
+    Parameters:
+        allowed_lateness (float): seconds an event may trail the newest event
+        max_delay (float): the longest an event waits in the buffer, in wall seconds
+        max_events (int): the most events to hold
+    """
+
+    def __init__(self, allowed_lateness: float=allowed_lateness, max_delay: float=max_delay,
+                 max_events: int=max_events):
+        self.allowed_lateness = allowed_lateness
+        self.max_delay = max_delay
+        self.max_events = max_events
+        # (event time, arrival order, arrival time, item) ordered by event time
+        self.heap = []
+        self.order = itertools.count()
+        self.max_event_time = None
+        # events older than the watermark have been released or are late
+        self.watermark = None
+        self.late_count = 0
+
+    def add(self, event_time: float, item, now: float=None) -> bool:
+        """
+        Add an event to the buffer
+        Parameters:
+            event_time (float): when the event happened, in epoch seconds
+            item: the event
+            now (float): the wall time (defaults to time.monotonic())
+        Returns:
+            True if the event was buffered, False if it is late
+        """
+        if self.watermark is not None and event_time < self.watermark:
+            self.late_count += 1
+            return False
+        now = time.monotonic() if now is None else now
+        heapq.heappush(self.heap, (event_time, next(self.order), now, item))
+        if self.max_event_time is None or event_time > self.max_event_time:
+            self.max_event_time = event_time
+        return True
+
+    def release(self, now: float=None, force: bool=False) -> list:
+        """
+        Release the events the watermark has passed, in event time order
+        Parameters:
+            now (float): the wall time (defaults to time.monotonic())
+            force (bool): release every event, e.g. when shutting down
+        Returns:
+            a list of (event time, item)
+        """
+        now = time.monotonic() if now is None else now
+        released = []
+        if self.max_event_time is not None:
+            self.advance(self.max_event_time - self.allowed_lateness)
+        while self.heap:
+            event_time, _, arrived, item = self.heap[0]
+            ready = self.watermark is not None and event_time <= self.watermark
+            waited = now - arrived >= self.max_delay
+            if not (force or ready or waited or len(self.heap) > self.max_events):
+                break
+            heapq.heappop(self.heap)
+            # an event released early moves the watermark up to it
+            self.advance(event_time)
+            released.append((event_time, item))
+        return released
+
+    def advance(self, watermark: float):
+        """
+        Move the watermark forward (it never moves back)
+        """
+        if self.watermark is None or watermark > self.watermark:
+            self.watermark = watermark
+
+    def __len__(self):
+        return len(self.heap)
@@ -0,0 +1,107 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module slows down and pauses the producer when its queues
+    are not being drained, so durable queues do not pile up in the
+    broker's memory and disk while the consumers are down or slow.
+
+    Before each polling cycle the depth and consumer count of every
+    queue is read with a passive declare:
+        - a queue at or above high_water messages, or at low_water
+          with no consumer reading it, is paused: its listings are not
+          fetched until the queue drops below low_water again
+        - between low_water and high_water the wait before the next
+          cycle grows, up to max_slowdown times the poll interval
+    Posts are not lost while a listing is paused, its cursor is kept
+    and the posts published since are fetched when it resumes.
+
+    The Publisher also stops publishing while the broker has blocked
+    the connection (connection.blocked, sent when it reaches its
+    memory or disk alarm), see reddit_publisher.py.
+'''
+
+######## imports ########
+from reddit_metrics import registry
+
+
+######## declare constants ########
+
+# set the queue depth (messages) that pauses fetching for the queue
+high_water = 10000
+
+# set the queue depth a paused queue must drop below to resume,
+# and the depth a queue with no consumer may fill to
+low_water = 2000
+
+# set the most the wait between polling cycles is stretched
+# as the queues fill from low_water to high_water
+max_slowdown = 4
+
+
+######## define classes ########
+
+class FlowControl:
+    """
+    Decide which queues may receive more messages, from their
+    depth and consumer count
+    Parameters:
+        high_water (int): the depth that pauses a queue
+        low_water (int): the depth a paused queue must drop below to resume
+        max_slowdown (float): the most the poll interval is stretched
+    """
+
+    def __init__(self, high_water: int=high_water, low_water: int=low_water, max_slowdown: float=max_slowdown):
+        if not 0 <= low_water < high_water:
+            raise ValueError("low_water must be at least 0 and below high_water")
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_slowdown = max_slowdown
+        # the last (depth, consumers) of each queue
+        self.depths = {}
+        self.paused = set()
+
+    def update(self, publisher, queue_names: list):
+        """
+        Read the depth and consumer count of each queue and pause or resume it
+        Parameters:
+            publisher (Publisher): reads the depths on its channel
+            queue_names (list): the queues to check
+        """
+        for queue_name in queue_names:
+            depth = publisher.queue_depth(queue_name)
+            if depth is None:
+                # the depth could not be read, keep the last decision
+                continue
+            messages, consumers = depth
+            self.depths[queue_name] = depth
+            registry.gauge("reddit_queue_depth", "Messages waiting in each queue", queue=queue_name).set(messages)
+            registry.gauge("reddit_queue_consumers", "Consumers reading each queue", queue=queue_name).set(consumers)
+            if queue_name in self.paused:
+                if messages < self.low_water:
+                    self.paused.discard(queue_name)
+                    print(f" [*] {queue_name} is below {self.low_water} messages, resuming")
+            elif messages >= self.high_water or (consumers == 0 and messages >= self.low_water):
+                self.paused.add(queue_name)
+                registry.counter("reddit_flow_pauses_total", "Times a queue was paused", queue=queue_name).inc()
+                print(f" [!] {queue_name} has {messages} messages and {consumers} consumers, pausing")
+            registry.gauge("reddit_queue_paused", "Queues paused by flow control",
+                           queue=queue_name).set(queue_name in self.paused)
+
+    def allowed(self, queue_name: str) -> bool:
+        """
+        Check if more messages may be published to a queue
+        """
+        return queue_name not in self.paused
+
+    def poll_wait(self, interval: float) -> float:
+        """
+        Get the wait before the next polling cycle, stretched as the
+        fullest queue that is not paused fills toward high_water
+        Parameters:
+            interval (float): the poll interval
+        """
+        fill = 0.0
+        for queue_name, (messages, _) in self.depths.items():
+            if queue_name not in self.paused:
+                fill = max(fill, (messages - self.low_water) / (self.high_water - self.low_water))
+        return interval * (1 + (self.max_slowdown - 1) * min(max(fill, 0.0), 1.0))
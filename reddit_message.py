@@ -0,0 +1,254 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module defines the message format shared by the producer
+    and the consumer. Each post is sent as a JSON record with a
+    schema version, and the content type and schema version are
+    also set on the message properties so the consumer can decode
+    the body in a single pass.
+
+    Messages in the original tagged string format
+    (tms-start/.../tms-end, sub-start/.../sub-end, ...) can still
+    be decoded while older messages are drained from the queues.
+
+    Large bodies are compressed (zlib, or zstd when the zstandard
+    package is installed on both ends) and flagged with the message's
+    content_encoding, so the consumer decompresses them transparently.
+    A body over max_body_bytes has its selftext truncated, or moved to
+    a blob file in blob_dir that the record refers to. The consumer
+    only reads the blob by its file name inside its own blob_dir, so
+    a message cannot make it read any other file.
+'''
+
+######## imports ########
+import json
+import os
+import re
+import zlib
+from datetime import datetime
+
+# zstd compression is optional
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+######## declare constants ########
+
+# set the version of the record layout, increase it when fields change
+schema_version = 1
+
+# set the content type of a JSON record and of the old tagged string
+content_type = "application/json"
+legacy_content_type = "text/plain"
+
+# the fields carried by every record, as extracted by df_from_response
+record_fields = ['subreddit', 'title', 'selftext', 'upvote_ratio', 'ups', 'downs',
+                 'score', 'link_flair_css_class', 'created_utc', 'id', 'kind']
+
+# set how to compress bodies: "zlib", "zstd" (needs the zstandard
+# package on the producer and consumer) or None (never compress)
+compression = "zlib"
+
+# set the smallest body, in bytes, worth compressing
+compress_threshold = 1024
+
+# set the compression level (zlib 1-9, zstd 1-22)
+compress_level = 6
+
+# the content_encoding set on a compressed message, for each compression
+content_encodings = {"zlib": "deflate", "zstd": "zstd"}
+
+# set the largest body, in bytes, before the selftext is cut down (None = no limit)
+max_body_bytes = None
+
+# set what to do with the selftext of a body over max_body_bytes:
+# "truncate" (cut it to fit) or "offload" (write it to a blob file
+# in blob_dir, which the consumer must be able to read)
+body_policy = "truncate"
+body_policies = ("truncate", "offload")
+blob_dir = "message_blobs"
+
+# timestamp format used by the old tagged string
+legacy_time_format = '%Y-%m-%d, %H:%M:%S'
+
+# pattern to split an old tagged string into fields in one scan,
+# the separators between tags keep a title containing "/title-end"
+# from ending the title early
+legacy_pattern = re.compile(r'tms-start/(?P<created_utc>.*?)/tms-end'
+                            r', sub-start/(?P<subreddit>.*?)/sub-end'
+                            r', flair-start/(?P<link_flair_css_class>.*?)/flair-end'
+                            r', title-start/(?P<title>.*?)/title-end'
+                            r', text-start/(?P<selftext>.*?)/text-end', re.DOTALL)
+
+
+######## define functions ########
+
+def message_headers() -> dict:
+    """
+    Create the message headers sent with every record
+    """
+    return {'schema_version': schema_version}
+
+def json_default(value):
+    """
+    Convert numpy scalars (e.g. from a dataframe row) to plain python values
+    Parameters:
+        value: a value the json module cannot serialize
+    """
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"cannot serialize {type(value).__name__}")
+
+def encode_message(record: dict) -> bytes:
+    """
+    Encode a post as a versioned JSON record
+    Parameters:
+        record (dict): the post fields, created_utc as epoch seconds
+    """
+    message = {'schema_version': schema_version}
+    for field in record_fields:
+        message[field] = record.get(field)
+    # keep created_utc as an epoch int so no date parsing is needed
+    if message['created_utc'] is not None:
+        message['created_utc'] = int(message['created_utc'])
+    body = dump_record(message)
+    if max_body_bytes is not None and len(body) > max_body_bytes and message['selftext']:
+        body = limit_body(message, body)
+    return body
+
+def dump_record(message: dict) -> bytes:
+    """
+    Serialize a record as compact JSON
+    """
+    return json.dumps(message, ensure_ascii=False, separators=(',', ':'),
+                      default=json_default).encode('utf-8')
+
+def limit_body(message: dict, body: bytes) -> bytes:
+    """
+    Bring a body over max_body_bytes down to size by truncating
+    its selftext or moving the selftext to a blob file
+    Parameters:
+        message (dict): the record
+        body (bytes): the record serialized
+    """
+    if body_policy not in body_policies:
+        raise ValueError(f"body_policy must be one of {body_policies}")
+    if body_policy == "offload":
+        os.makedirs(blob_dir, exist_ok=True)
+        blob_path = os.path.join(blob_dir, os.path.basename(str(message['id'])) + ".txt")
+        temp_path = blob_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as blob_file:
+            blob_file.write(message['selftext'])
+        os.replace(temp_path, blob_path)
+        message['selftext'] = ""
+        message['selftext_blob'] = blob_path
+        return dump_record(message)
+    message['selftext_truncated'] = True
+    while len(body) > max_body_bytes and message['selftext']:
+        text = message['selftext'].encode('utf-8')
+        # escaped characters take more room in the body than in the text,
+        # so scale the cut by how much the text grows when escaped
+        escaped = len(json.dumps(message['selftext'], ensure_ascii=False).encode('utf-8')) - 2
+        budget = max_body_bytes - (len(body) - escaped)
+        keep = min(len(text) - 1, max(0, len(text) * budget // escaped))
+        message['selftext'] = text[:keep].decode('utf-8', 'ignore')
+        body = dump_record(message)
+    return body
+
+def compress_message(body: bytes):
+    """
+    Compress a body if compression is turned on and it is large enough
+    Parameters:
+        body (bytes): the encoded record
+    Returns:
+        the body, and its content_encoding (None if it was not compressed)
+    """
+    if compression is None or len(body) < compress_threshold:
+        return body, None
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        compressed = zstandard.ZstdCompressor(level=compress_level).compress(body)
+    else:
+        compressed = zlib.compress(body, compress_level)
+    # keep the original when compressing does not help
+    if len(compressed) >= len(body):
+        return body, None
+    return compressed, content_encodings[compression]
+
+def decompress_message(body: bytes, content_encoding: str=None) -> bytes:
+    """
+    Decompress a body according to its content_encoding
+    Parameters:
+        body (bytes): the message body
+        content_encoding (str): the content_encoding from the message properties
+    """
+    if content_encoding is None:
+        return body
+    if content_encoding == content_encodings["zlib"]:
+        return zlib.decompress(body)
+    if content_encoding == content_encodings["zstd"]:
+        if zstandard is None:
+            raise ValueError("zstd messages need the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(body)
+    raise ValueError(f"unsupported content encoding {content_encoding}")
+
+def decode_legacy_message(text: str) -> dict:
+    """
+    Decode a message in the old tagged string format
+    Parameters:
+        text (str): the decoded message body
+    """
+    match = legacy_pattern.search(text)
+    if match is None:
+        raise ValueError("message is not a JSON record or a tagged string")
+    record = dict.fromkeys(record_fields)
+    record.update(match.groupdict())
+    record['schema_version'] = 0
+    # the tagged string wrote a missing flair as "None"
+    if record['link_flair_css_class'] in ("None", ""):
+        record['link_flair_css_class'] = None
+    # convert the local timestamp back to epoch seconds
+    record['created_utc'] = int(datetime.strptime(record['created_utc'], legacy_time_format).timestamp())
+    return record
+
+def blob_path(name: str) -> str:
+    """
+    Get the path of a blob file from the name in a record, only ever
+    inside blob_dir: any folders in the name are dropped, and a name
+    that still resolves outside blob_dir (e.g. through a link) is refused
+    Parameters:
+        name (str): the selftext_blob of a record
+    """
+    folder = os.path.realpath(blob_dir)
+    path = os.path.realpath(os.path.join(folder, os.path.basename(str(name))))
+    if os.path.dirname(path) != folder:
+        raise ValueError(f"selftext_blob {name!r} is not a file in {blob_dir}")
+    return path
+
+def decode_message(body: bytes, message_content_type: str=None, content_encoding: str=None) -> dict:
+    """
+    Decode a message body into a record in a single pass.
+    A JSON record is detected from the content type, or from the
+    body when the content type is not set.
+    Parameters:
+        body (bytes): the message body
+        message_content_type (str): the content type from the message properties
+        content_encoding (str): the content_encoding from the message properties
+    """
+    if isinstance(body, (bytes, bytearray)):
+        text = decompress_message(body, content_encoding).decode('utf-8')
+    else:
+        text = body
+    if message_content_type == content_type or (message_content_type is None and text.startswith('{')):
+        record = json.loads(text)
+        if record.get('schema_version', 0) > schema_version:
+            raise ValueError(f"unsupported schema version {record['schema_version']}")
+        # read back a selftext that was moved to a blob file
+        if record.get('selftext_blob'):
+            with open(blob_path(record['selftext_blob']), encoding="utf-8") as blob_file:
+                record['selftext'] = blob_file.read()
+        return record
+    return decode_legacy_message(text)
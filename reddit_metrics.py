@@ -0,0 +1,344 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module keeps counters, gauges and latency histograms for the
+    producer and consumer, so the stage that is saturating under load
+    can be found without printing every message.
+
+    Every stage (fetch, publish, parse, write, store, alert, analytics) is timed
+    into reddit_stage_seconds{stage="..."}, with the CPU time of the
+    thread that ran it in reddit_stage_cpu_seconds_total. Stage times
+    include any stage they call (a full batch is published inside
+    publish).
+
+    The metrics can be served in the Prometheus text format
+    (http://localhost:<port>/metrics) and/or written to a snapshot file
+    every few seconds. A sampling profiler can also record where the
+    threads spend their time, as collapsed stacks for a flame graph.
+'''
+
+######## imports ########
+import bisect
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+######## declare constants ########
+
+# upper bounds (seconds) of the histogram buckets used for stage times
+duration_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# upper bounds (seconds) of the histogram buckets used for consumer lag,
+# from one second up to one week
+lag_buckets = (1, 10, 60, 300, 900, 3600, 4 * 3600, 12 * 3600, 24 * 3600, 7 * 24 * 3600)
+
+# set how many seconds to wait between snapshot files
+snapshot_interval = 10
+
+# set how many seconds to wait between profiler samples
+profile_interval = 0.005
+
+
+######## define functions ########
+
+def format_labels(labels: tuple) -> str:
+    """
+    Format (name, value) label pairs in the Prometheus text format
+    """
+    if not labels:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+######## define classes ########
+
+class Counter:
+    """
+    A value that only goes up
+    """
+
+    kind = "counter"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: tuple):
+        yield name, labels, self.value
+
+
+class Gauge:
+    """
+    A value that can go up and down
+    """
+
+    kind = "gauge"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def set(self, value: float):
+        with self.lock:
+            self.value = value
+
+    def inc(self, amount: float=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: tuple):
+        yield name, labels, self.value
+
+
+class Histogram:
+    """
+    Count observations in fixed buckets, with their sum
+    Parameters:
+        buckets (tuple): the upper bound of each bucket, in increasing order
+    """
+
+    kind = "histogram"
+
+    def __init__(self, buckets: tuple=duration_buckets):
+        self.lock = threading.Lock()
+        self.bounds = tuple(buckets)
+        # one count per bucket plus the open (+Inf) bucket
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name: str, labels: tuple):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        running = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            running += count
+            le = "+Inf" if bound == float('inf') else repr(float(bound))
+            yield f"{name}_bucket", labels + (('le', le),), running
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, running
+
+
+class MetricsRegistry:
+    """
+    The metrics of a process, by name and labels
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (help, {labels: metric})
+        self.families = {}
+
+    def metric(self, factory, name: str, help: str, labels: dict, *args):
+        """
+        Get the metric with a name and labels, creating it on first use
+        """
+        key = tuple(sorted(labels.items()))
+        family = self.families.get(name)
+        if family is None or key not in family[1]:
+            with self.lock:
+                family = self.families.setdefault(name, (help, {}))
+                if key not in family[1]:
+                    family[1][key] = factory(*args)
+        return family[1][key]
+
+    def counter(self, name: str, help: str="", **labels) -> Counter:
+        return self.metric(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str="", **labels) -> Gauge:
+        return self.metric(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str="", buckets: tuple=duration_buckets, **labels) -> Histogram:
+        return self.metric(Histogram, name, help, labels, buckets)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """
+        Time the block as a stage, in wall and thread CPU seconds
+        Parameters:
+            stage (str): the stage name, e.g. fetch
+        """
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.histogram("reddit_stage_seconds", "Time spent in each stage",
+                           stage=stage).observe(time.perf_counter() - wall)
+            self.counter("reddit_stage_cpu_seconds_total", "CPU time of the thread running each stage",
+                         stage=stage).inc(time.thread_time() - cpu)
+
+    def timed(self, stage: str):
+        """
+        Decorate a function so each call is timed as a stage
+        """
+        def decorate(function):
+            @functools.wraps(function)
+            def timed_function(*args, **kwargs):
+                with self.timer(stage):
+                    return function(*args, **kwargs)
+            return timed_function
+        return decorate
+
+    def render(self) -> str:
+        """
+        Get every metric in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            families = [(name, help, list(metrics.items())) for name, (help, metrics) in sorted(self.families.items())]
+        for name, help, metrics in families:
+            if not metrics:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {metrics[0][1].kind}")
+            for labels, metric in metrics:
+                for sample_name, sample_labels, value in metric.samples(name, labels):
+                    lines.append(f"{sample_name}{format_labels(sample_labels)} {value!r}")
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self, path: str):
+        """
+        Write every metric to a file, replacing it in one step
+        so a reader never sees half a snapshot
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as snapshot_file:
+            snapshot_file.write(self.render())
+        os.replace(temp_path, path)
+
+
+class MetricsExporter:
+    """
+    Serve the metrics over HTTP and/or write them to a snapshot
+    file periodically, on background threads
+    Parameters:
+        registry (MetricsRegistry): the metrics to export
+        port (int): the port to serve /metrics on (None = do not serve)
+        snapshot_path (str): the snapshot file (None = do not write one)
+        interval (float): the seconds between snapshot files
+    """
+
+    def __init__(self, registry, port: int=None, snapshot_path: str=None, interval: float=snapshot_interval):
+        self.registry = registry
+        self.port = port
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self.server = None
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        """
+        Start serving and/or writing snapshots
+        """
+        if self.port is not None:
+            registry = self.registry
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def log_message(self, format, *args):
+                    pass
+
+                def do_GET(self):
+                    body = registry.render().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            self.server = ThreadingHTTPServer(("", self.port), MetricsHandler)
+            self.threads.append(threading.Thread(target=self.server.serve_forever, daemon=True))
+        if self.snapshot_path is not None:
+            self.threads.append(threading.Thread(target=self.write_snapshots, daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def write_snapshots(self):
+        while not self.stopped.wait(self.interval):
+            self.registry.write_snapshot(self.snapshot_path)
+
+    def close(self):
+        """
+        Stop serving and write a last snapshot
+        """
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.snapshot_path is not None:
+            self.registry.write_snapshot(self.snapshot_path)
+
+
+class SamplingProfiler:
+    """
+    Sample the stack of every thread at a fixed interval and count
+    each stack, written as collapsed stacks (one "frame;frame count"
+    line per stack) for flame graph tools such as speedscope
+    Parameters:
+        path (str): the file to write the stacks to when stopped
+        interval (float): the seconds between samples
+    """
+
+    def __init__(self, path: str, interval: float=profile_interval):
+        self.path = path
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def sample(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """
+        Stop sampling and write the stacks
+        """
+        self.stopped.set()
+        self.thread.join()
+        with open(self.path, "w", encoding="utf-8") as profile_file:
+            for stack, count in self.stacks.most_common():
+                profile_file.write(f"{stack} {count}\n")
+
+
+######## declare the shared registry ########
+
+# the metrics of this process, shared by every module
+registry = MetricsRegistry()
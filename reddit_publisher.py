@@ -0,0 +1,372 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module keeps one long-lived connection and channel to the
+    RabbitMQ server for the producer. Each queue and exchange is
+    declared once, messages are buffered in batches and published
+    persistent with publisher confirms, and the connection is re-opened
+    automatically if the broker goes away instead of stopping the producer.
+    A batch only buffers the messages: the blocking channel still waits
+    for the broker to confirm each message before publishing the next.
+    An error is retried with the same growing delay as a reconnect,
+    except a channel the broker closed for a wrong declare or a missing
+    queue or exchange (see fatal_reply_codes), which would fail again.
+
+    When the broker blocks the connection (connection.blocked, sent
+    when it reaches its memory or disk alarm) the producer waits for
+    it to be unblocked before fetching more posts, and a publish that
+    stays blocked for blocked_timeout seconds is retried on a new
+    connection instead of hanging.
+'''
+
+######## imports ########
+import time
+from collections import deque
+
+import pika
+
+from reddit_metrics import registry
+
+
+######## declare constants ########
+
+# set how many messages to buffer before publishing them as a batch
+batch_size = 20
+
+# set how many seconds to wait before reconnecting to the server,
+# the wait doubles after each failed attempt up to the maximum
+reconnect_delay = 1
+max_reconnect_delay = 30
+
+# set how many seconds a blocked connection may hold up a publish
+# before it is closed and the publish is retried
+blocked_timeout = 300
+
+# errors that mean the connection or channel has to be re-opened
+# (NackError is raised when the broker refuses to confirm a message)
+retry_errors = (pika.exceptions.AMQPConnectionError,
+                pika.exceptions.AMQPChannelError,
+                pika.exceptions.NackError)
+
+# reply codes of a channel closed by the broker that retrying cannot fix:
+# 403 access refused, 404 not found, 406 precondition failed
+# (e.g. an exchange or queue already declared with other settings)
+fatal_reply_codes = (403, 404, 406)
+
+# make the broker write the messages to disk, so the durable queues
+# keep them when the server restarts
+delivery_mode = pika.DeliveryMode.Persistent
+
+
+######## define functions ########
+
+def declare_durable_queue(connection, channel, queue_name: str, arguments: dict=None):
+    """
+    Declare a durable queue with arguments (e.g. its dead-letter exchange).
+    A queue that already exists without them (declared by an earlier
+    version) makes the broker close the channel with 406, so it is
+    declared again as it is, on a new channel, with a warning. Its
+    dead-letter exchange can then be set with a policy, see reddit_config.py.
+    Parameters:
+        connection: the connection the channel is on
+        channel: the channel to declare the queue on
+        queue_name (str): the name of the queue
+        arguments (dict): the queue arguments
+    Returns:
+        the channel to keep using, a new one if the broker closed it
+    """
+    try:
+        channel.queue_declare(queue=queue_name, durable=True, arguments=arguments)
+        return channel
+    except pika.exceptions.ChannelClosedByBroker as e:
+        if not arguments or e.reply_code != 406:
+            raise
+        print(f"Warning: {queue_name} already exists without {', '.join(arguments)}, using it as it is "
+              f"(set them with a RabbitMQ policy, see reddit_config.py)")
+        channel = connection.channel()
+        channel.queue_declare(queue=queue_name, durable=True)
+        return channel
+
+
+######## define classes ########
+
+class Publisher:
+    """
+    Publish messages to durable queues over one connection
+    and channel that stay open for the life of the process.
+    Parameters:
+        host (str): the host name or IP address of the RabbitMQ server
+        batch_size (int): the number of messages to buffer before publishing
+        max_retries (int): reconnect or publish attempts in a row before giving up (None = keep trying)
+        connection_factory: optional callable returning a connection,
+            defaults to a pika.BlockingConnection to host
+    """
+
+    def __init__(self, host: str, batch_size: int=batch_size, max_retries: int=None,
+                 connection_factory=None):
+        self.host = host
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.connection_factory = connection_factory or self._blocking_connection
+        self.connection = None
+        self.channel = None
+        # queues and exchanges declared on the current channel
+        self.declared = set()
+        # the arguments each queue is declared with, e.g. its dead-letter exchange
+        self.queue_arguments = {}
+        self.declared_exchanges = set()
+        # per exchange, its type and the (queue, routing key) bindings
+        # declared with it, so they are declared again after reconnecting
+        self.exchanges = {}
+        # messages waiting to be published and confirmed
+        self.pending = deque()
+        # set while the broker has blocked the connection
+        self.blocked = False
+
+    def _blocking_connection(self):
+        """
+        Create a blocking connection to the RabbitMQ server
+        """
+        return pika.BlockingConnection(pika.ConnectionParameters(self.host, blocked_connection_timeout=blocked_timeout))
+
+    def connect(self):
+        """
+        Open the connection and channel, retrying with a growing
+        delay until the server is reachable or max_retries is used up
+        """
+        delay = reconnect_delay
+        attempt = 0
+        while True:
+            try:
+                # create a blocking connection to the RabbitMQ server
+                self.connection = self.connection_factory()
+                # follow the broker's memory and disk alarms
+                self.blocked = False
+                self.connection.add_on_connection_blocked_callback(self._on_blocked)
+                self.connection.add_on_connection_unblocked_callback(self._on_unblocked)
+                # use the connection to create a communication channel
+                self.channel = self.connection.channel()
+                # turn on publisher confirms so the broker
+                # acknowledges every message it has accepted
+                self.channel.confirm_delivery()
+                # queues must be declared again on a new channel
+                self.declared = set()
+                self.declared_exchanges = set()
+                return
+            except pika.exceptions.AMQPConnectionError as e:
+                attempt += 1
+                if self.max_retries is not None and attempt > self.max_retries:
+                    raise
+                print(f"Error: Connection to RabbitMQ server failed: {e}")
+                print(f"Reconnecting in {delay} seconds...")
+                time.sleep(delay)
+                delay = min(delay * 2, max_reconnect_delay)
+
+    def _on_blocked(self, connection, method_frame):
+        self.blocked = True
+        registry.gauge("reddit_broker_blocked", "Whether the broker has blocked publishing").set(1)
+        print(f"Warning: RabbitMQ server blocked publishing: {getattr(method_frame.method, 'reason', '')}")
+
+    def _on_unblocked(self, connection, method_frame):
+        self.blocked = False
+        registry.gauge("reddit_broker_blocked", "Whether the broker has blocked publishing").set(0)
+        print("RabbitMQ server unblocked publishing")
+
+    def wait_while_blocked(self, check_seconds: float=1):
+        """
+        Wait, answering heartbeats, until the broker unblocks the connection
+        Parameters:
+            check_seconds (float): the seconds between checks
+        """
+        while self.blocked and self.connection is not None and self.connection.is_open:
+            self.sleep(check_seconds)
+
+    def queue_depth(self, queue_name: str):
+        """
+        Get the messages waiting in a queue and the consumers reading it,
+        with a passive declare that does not change the queue
+        Parameters:
+            queue_name (str): the name of the queue
+        Returns:
+            (message count, consumer count), or None if the server could not be reached
+        """
+        try:
+            if self.channel is None or not self.channel.is_open:
+                self.connect()
+            # a passive declare of a missing queue closes the channel,
+            # so make sure it exists first
+            self.declare_queue(queue_name)
+            method = self.channel.queue_declare(queue=queue_name, passive=True).method
+            return method.message_count, method.consumer_count
+        except retry_errors as e:
+            print(f"Error: Reading the depth of {queue_name} failed: {e}")
+            self._drop_connection()
+            return None
+
+    def declare_queue(self, queue_name: str):
+        """
+        Declare a durable queue the first time it is used on the channel.
+        A durable queue will survive a RabbitMQ server restart.
+        Parameters:
+            queue_name (str): the name of the queue
+        """
+        if queue_name not in self.declared:
+            channel = declare_durable_queue(self.connection, self.channel, queue_name,
+                                            self.queue_arguments.get(queue_name))
+            if channel is not self.channel:
+                # the broker closed the channel, keep confirms on the new one
+                channel.confirm_delivery()
+                self.channel = channel
+            self.declared.add(queue_name)
+
+    def delete_queue(self, queue_name: str):
+        """
+        Delete a queue and the messages in it, on the publisher's connection.
+        The queue and its bindings are declared again before the next publish.
+        Parameters:
+            queue_name (str): the name of the queue
+        """
+        if self.channel is None or not self.channel.is_open:
+            self.connect()
+        self.channel.queue_delete(queue=queue_name)
+        self.declared.discard(queue_name)
+        self.declared_exchanges = set()
+
+    def bind(self, exchange: str, queue_name: str, routing_key: str, exchange_type: str="topic",
+             arguments: dict=None):
+        """
+        Route the messages published to an exchange with a routing key
+        (or pattern) into a durable queue, so they are kept until a
+        consumer reads them. The exchange, queue and binding are
+        declared before the first message is published to the exchange.
+        Parameters:
+            exchange (str): the name of the exchange
+            queue_name (str): the name of the queue
+            routing_key (str): the routing key or pattern to bind
+            exchange_type (str): the type of the exchange
+            arguments (dict): the arguments to declare the queue with
+        """
+        if arguments is not None:
+            self.queue_arguments[queue_name] = arguments
+        bindings = self.exchanges.setdefault(exchange, (exchange_type, []))[1]
+        if (queue_name, routing_key) not in bindings:
+            bindings.append((queue_name, routing_key))
+            self.declared_exchanges.discard(exchange)
+
+    def declare_exchange(self, exchange: str):
+        """
+        Declare a durable exchange and its bindings the first time it is used on the channel
+        Parameters:
+            exchange (str): the name of the exchange
+        """
+        if exchange not in self.declared_exchanges:
+            exchange_type, bindings = self.exchanges.get(exchange, ("topic", []))
+            self.channel.exchange_declare(exchange=exchange, exchange_type=exchange_type, durable=True)
+            for queue_name, routing_key in bindings:
+                self.declare_queue(queue_name)
+                self.channel.queue_bind(queue=queue_name, exchange=exchange, routing_key=routing_key)
+            self.declared_exchanges.add(exchange)
+
+    def publish(self, queue_name: str, message: bytes, properties=None, exchange: str=""):
+        """
+        Add a message to the current batch and publish the
+        batch once it is full
+        Parameters:
+            queue_name (str): the name of the queue, or the routing key
+                when publishing to an exchange
+            message (bytes): the message body
+            properties (pika.BasicProperties): optional message properties
+            exchange (str): the exchange ("" = straight to the queue)
+        """
+        self.pending.append((exchange, queue_name, message, properties))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Publish every buffered message. With confirms turned on the
+        blocking channel returns from basic_publish only after the
+        broker has accepted the message, so a message leaves the
+        buffer only once it is safe. If the connection is lost the
+        remaining messages are published again after reconnecting,
+        waiting longer after each failure in a row. A channel error
+        that would fail again, or max_retries failures in a row,
+        is raised with the messages still buffered.
+        """
+        delay = reconnect_delay
+        attempt = 0
+        while self.pending:
+            if self.channel is None or not self.channel.is_open:
+                self.connect()
+            try:
+                while self.pending:
+                    exchange, queue_name, message, properties = self.pending[0]
+                    if exchange:
+                        self.declare_exchange(exchange)
+                    else:
+                        self.declare_queue(queue_name)
+                    # every message passes through an exchange,
+                    # the default exchange routes it to the queue of that name
+                    self.channel.basic_publish(exchange=exchange, routing_key=queue_name,
+                                               body=message, properties=properties)
+                    self.pending.popleft()
+                    registry.counter("reddit_messages_published_total", "Messages confirmed by the broker",
+                                     queue=queue_name).inc()
+                    registry.counter("reddit_bytes_published_total", "Message bytes confirmed by the broker",
+                                     queue=queue_name).inc(len(message))
+                    # the broker accepted a message, so start the waits over
+                    delay = reconnect_delay
+                    attempt = 0
+            except retry_errors as e:
+                print(f"Error: Publishing to RabbitMQ server failed: {e}")
+                self._drop_connection()
+                attempt += 1
+                if getattr(e, 'reply_code', None) in fatal_reply_codes or (
+                        self.max_retries is not None and attempt > self.max_retries):
+                    raise
+                registry.counter("reddit_publish_errors_total", "Publishes that failed and were retried").inc()
+                print(f"Retrying in {delay} seconds...")
+                time.sleep(delay)
+                delay = min(delay * 2, max_reconnect_delay)
+
+    def sleep(self, seconds: float):
+        """
+        Wait between publishes while still answering heartbeats,
+        so the broker does not drop an idle connection
+        Parameters:
+            seconds (float): the number of seconds to wait
+        """
+        if self.connection is not None and self.connection.is_open:
+            try:
+                self.connection.sleep(seconds)
+                return
+            except retry_errors:
+                self._drop_connection()
+        time.sleep(seconds)
+
+    def _drop_connection(self):
+        """
+        Forget a broken connection so the next flush reconnects
+        """
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except retry_errors:
+            pass
+        self.connection = None
+        self.channel = None
+
+    def close(self):
+        """
+        Publish any buffered messages and close the connection
+        """
+        try:
+            self.flush()
+        finally:
+            self._drop_connection()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,288 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module keeps a local, append-only log of every message the
+    producer publishes, so the consumer can reprocess history (e.g.
+    after a change to the cleaning or alert logic) at disk speed
+    instead of polling reddit again.
+
+    The log is a folder of segment files named by the offset of their
+    first record (00000000000000000000.log, ...). A new segment is
+    started once the current one reaches segment_bytes. Each record is
+
+        header  - offset, timestamp (epoch seconds it was appended),
+                  the lengths of the next four fields and a crc32
+        routing key, content type, content encoding, body
+
+    Next to each segment an index file (.index) holds the offset,
+    timestamp and file position of the first record and of a record
+    every index_interval bytes, so a reader can start at a time
+    without scanning the segments before it. A record cut off by a
+    crash is dropped when the log is opened again.
+'''
+
+######## imports ########
+import bisect
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+
+######## declare constants ########
+
+# set the folder the log is kept in
+log_dir = "record_log"
+
+# set the size of a segment file before a new one is started
+segment_bytes = 64 * 1024 * 1024
+
+# set how many bytes of records to write between index entries
+index_interval = 4096
+
+# set to sync the segment to disk every time the log is flushed (True)
+# or to leave it to the operating system (False)
+fsync_on_flush = False
+
+# the record header: offset, timestamp, routing key, content type,
+# content encoding and body lengths, then the crc32 of the record
+record_header = struct.Struct(">QdHHHII")
+
+# an index entry: offset, timestamp, position in the segment
+index_entry = struct.Struct(">QdQ")
+
+# a record read back from the log
+Record = namedtuple("Record", ["offset", "timestamp", "routing_key", "content_type", "content_encoding", "body"])
+
+
+######## define functions ########
+
+def encode_field(value: str) -> bytes:
+    """
+    Encode an optional text field (None is written as empty)
+    """
+    return value.encode("utf-8") if value else b""
+
+def decode_field(value: bytes):
+    """
+    Decode an optional text field (empty is read as None)
+    """
+    return bytes(value).decode("utf-8") if value else None
+
+def record_crc(header_fields: tuple, payload) -> int:
+    """
+    Get the crc32 of a record, its header fields and payload
+    """
+    return zlib.crc32(payload, zlib.crc32(record_header.pack(*header_fields, 0)))
+
+def segment_paths(directory: str) -> list:
+    """
+    Get the (base offset, log path, index path) of each segment, oldest first
+    """
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in os.listdir(directory):
+        base, extension = os.path.splitext(name)
+        if extension == ".log" and base.isdigit():
+            segments.append((int(base), os.path.join(directory, name), os.path.join(directory, base + ".index")))
+    return sorted(segments)
+
+def read_index(index_path: str) -> list:
+    """
+    Read the (offset, timestamp, position) entries of a segment's index
+    """
+    try:
+        with open(index_path, "rb") as index_file:
+            data = index_file.read()
+    except FileNotFoundError:
+        return []
+    # ignore an entry cut off by a crash
+    end = len(data) - len(data) % index_entry.size
+    return [index_entry.unpack_from(data, position) for position in range(0, end, index_entry.size)]
+
+def scan_records(data, position: int=0):
+    """
+    Read the records of a segment from a position, stopping at the
+    end of the data or at a record that is cut off or damaged
+    Parameters:
+        data: the segment contents (bytes or mmap)
+        position (int): where to start reading
+    Returns:
+        (record, position after the record) for each record
+    """
+    size = len(data)
+    while position + record_header.size <= size:
+        fields = record_header.unpack_from(data, position)
+        offset, timestamp, key_length, type_length, encoding_length, body_length, crc = fields
+        start = position + record_header.size
+        end = start + key_length + type_length + encoding_length + body_length
+        if end > size:
+            return
+        # release the view before yielding, so the segment can be unmapped
+        with memoryview(data) as view, view[start:end] as payload:
+            damaged = record_crc(fields[:-1], payload) != crc
+        if damaged:
+            return
+        type_start = start + key_length
+        encoding_start = type_start + type_length
+        body_start = encoding_start + encoding_length
+        yield Record(offset, timestamp, decode_field(data[start:type_start]), decode_field(data[type_start:encoding_start]),
+                     decode_field(data[encoding_start:body_start]), bytes(data[body_start:end])), end
+        position = end
+
+def read_log(directory: str=log_dir, start_time: float=None, end_time: float=None):
+    """
+    Read the records of the log in order, memory-mapping each segment
+    Parameters:
+        directory (str): the log folder
+        start_time (float): skip records appended before this time, in epoch seconds (None = from the start)
+        end_time (float): stop at the first record appended after this time (None = to the end)
+    Returns:
+        each Record
+    """
+    segments = [(paths, read_index(paths[2])) for paths in segment_paths(directory)]
+    for number, ((base, log_path, index_path), index) in enumerate(segments):
+        # skip a segment when the next one starts before start_time
+        if start_time is not None and number + 1 < len(segments):
+            next_index = segments[number + 1][1]
+            if next_index and next_index[0][1] <= start_time:
+                continue
+        # start at the last index entry before start_time
+        position = 0
+        if start_time is not None and index:
+            entry = bisect.bisect_left([timestamp for _, timestamp, _ in index], start_time) - 1
+            if entry >= 0:
+                position = index[entry][2]
+        with open(log_path, "rb") as log_file:
+            if os.fstat(log_file.fileno()).st_size == 0:
+                continue
+            with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for record, _ in scan_records(data, position):
+                    if start_time is not None and record.timestamp < start_time:
+                        continue
+                    if end_time is not None and record.timestamp > end_time:
+                        return
+                    yield record
+
+
+######## define classes ########
+
+class RecordLog:
+    """
+    Append messages to a segmented log with an offset index
+    Parameters:
+        directory (str): the log folder, created if needed
+        segment_bytes (int): the size of a segment before a new one is started
+        index_interval (int): the bytes of records between index entries
+        fsync_on_flush (bool): sync the segment to disk on every flush
+    """
+
+    def __init__(self, directory: str=log_dir, segment_bytes: int=segment_bytes,
+                 index_interval: int=index_interval, fsync_on_flush: bool=fsync_on_flush):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.fsync_on_flush = fsync_on_flush
+        os.makedirs(directory, exist_ok=True)
+        self.log_file = None
+        self.index_file = None
+        segments = segment_paths(directory)
+        if segments:
+            self.recover(*segments[-1])
+        else:
+            self.next_offset = 0
+            self.open_segment(0)
+
+    def recover(self, base: int, log_path: str, index_path: str):
+        """
+        Open the last segment for appending, dropping a record
+        cut off by a crash and the index entries after it
+        """
+        file_size = os.path.getsize(log_path)
+        # the index can be written ahead of the records it points to
+        index = [entry for entry in read_index(index_path) if entry[2] < file_size]
+        # the records before the last index entry were written before it,
+        # so only the records from there on are checked
+        position, self.next_offset = (index[-1][2], index[-1][0]) if index else (0, base)
+        with open(log_path, "rb") as log_file:
+            log_file.seek(position)
+            data = log_file.read()
+        size = position
+        for record, end in scan_records(data):
+            self.next_offset = record.offset + 1
+            size = position + end
+        index = [entry for entry in index if entry[2] < size]
+        with open(index_path, "wb") as index_file:
+            index_file.write(b"".join(index_entry.pack(*entry) for entry in index))
+        self.log_file = open(log_path, "r+b")
+        self.log_file.truncate(size)
+        self.log_file.seek(size)
+        self.index_file = open(index_path, "ab")
+        self.base = base
+        # the position of the last index entry
+        self.indexed = index[-1][2] if index else -self.index_interval
+
+    def open_segment(self, base: int):
+        """
+        Start a new segment whose first record has the offset base
+        """
+        name = f"{base:020d}"
+        self.log_file = open(os.path.join(self.directory, name + ".log"), "wb")
+        self.index_file = open(os.path.join(self.directory, name + ".index"), "wb")
+        self.base = base
+        self.indexed = -self.index_interval
+
+    def append(self, routing_key: str, body: bytes, content_type: str=None, content_encoding: str=None,
+               timestamp: float=None) -> int:
+        """
+        Append a message to the log
+        Parameters:
+            routing_key (str): the routing key (or queue) it was published with
+            body (bytes): the message body, as published
+            content_type (str): the content type from the message properties
+            content_encoding (str): the content_encoding from the message properties
+            timestamp (float): when it was published, in epoch seconds (None = now)
+        Returns:
+            the offset of the record
+        """
+        if self.log_file.tell() >= self.segment_bytes:
+            self.close_segment()
+            self.open_segment(self.next_offset)
+        if timestamp is None:
+            timestamp = time.time()
+        key, type_, encoding = encode_field(routing_key), encode_field(content_type), encode_field(content_encoding)
+        payload = key + type_ + encoding + bytes(body)
+        fields = (self.next_offset, timestamp, len(key), len(type_), len(encoding), len(body))
+        position = self.log_file.tell()
+        # index the first record of the segment and a record every index_interval bytes
+        if position - self.indexed >= self.index_interval:
+            self.index_file.write(index_entry.pack(self.next_offset, timestamp, position))
+            self.indexed = position
+        self.log_file.write(record_header.pack(*fields, record_crc(fields, payload)))
+        self.log_file.write(payload)
+        self.next_offset += 1
+        return self.next_offset - 1
+
+    def flush(self):
+        """
+        Write the buffered records, and sync them if turned on
+        """
+        self.log_file.flush()
+        self.index_file.flush()
+        if self.fsync_on_flush:
+            os.fsync(self.log_file.fileno())
+
+    def close_segment(self):
+        self.flush()
+        self.log_file.close()
+        self.index_file.close()
+
+    def close(self):
+        """
+        Write the buffered records and close the log
+        """
+        if not self.log_file.closed:
+            self.close_segment()
@@ -0,0 +1,148 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module fetches many reddit listings at the same time while
+    sharing one rate budget between them.
+
+    Reddit reports the budget on every API response:
+        X-Ratelimit-Remaining - requests left in the current window
+        X-Ratelimit-Reset     - seconds until the window starts over
+    RateLimiter keeps a token bucket filled from those headers and
+    spaces requests evenly over what is left of the window, so the
+    whole budget is used without going over it.
+'''
+
+######## imports ########
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+######## declare constants ########
+
+# set the budget to assume before the first response reports it
+# (reddit allows 600 requests per 10 minute window for OAuth clients)
+default_remaining = 600
+default_reset = 600
+
+# set how many listings to fetch at the same time
+max_workers = 8
+
+
+######## define classes ########
+
+class RateLimiter:
+    """
+    A token bucket shared by every fetch thread and refilled
+    from the rate limit headers of each response
+    Parameters:
+        remaining (float): requests to allow before the first response
+        reset (float): seconds until the first window resets
+        pace (bool): space requests evenly over the window (True)
+            or allow them as fast as tokens last (False)
+    """
+
+    def __init__(self, remaining: float=default_remaining, reset: float=default_reset, pace: bool=True):
+        self.condition = threading.Condition()
+        self.tokens = remaining
+        self.reset_at = time.monotonic() + reset
+        self.pace = pace
+        self.last_grant = 0.0
+        # requests granted whose response has not been seen yet
+        self.in_flight = 0
+
+    def acquire(self):
+        """
+        Wait until the budget allows one more request
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if now >= self.reset_at and self.in_flight == 0 and self.tokens < 1:
+                    # the window has reset, allow one request to learn the new budget
+                    self.tokens = 1
+                if self.tokens >= 1:
+                    wait = 0.0
+                    if self.pace:
+                        # spread what is left of the budget over what is left of the window
+                        interval = max(0.0, self.reset_at - now) / self.tokens
+                        wait = self.last_grant + interval - now
+                    if wait <= 0:
+                        self.tokens -= 1
+                        self.in_flight += 1
+                        self.last_grant = now
+                        return
+                else:
+                    # out of budget, wait for the window to reset
+                    # or for a response to report more budget
+                    wait = max(self.reset_at - now, 0.05)
+                self.condition.wait(wait)
+
+    def update(self, headers=None):
+        """
+        Refill the bucket from the rate limit headers of a response
+        Parameters:
+            headers: the response headers (None if the request failed)
+        """
+        with self.condition:
+            self.in_flight = max(0, self.in_flight - 1)
+            try:
+                remaining = float(headers['X-Ratelimit-Remaining'])
+                reset = float(headers['X-Ratelimit-Reset'])
+            except (TypeError, KeyError, ValueError):
+                self.condition.notify_all()
+                return
+            # requests still in flight are not counted in remaining yet
+            self.tokens = max(0.0, remaining - self.in_flight)
+            self.reset_at = time.monotonic() + reset
+            self.condition.notify_all()
+
+    def request(self, send, *args, **kwargs):
+        """
+        Send a request within the budget and update the budget
+        from its response
+        Parameters:
+            send: the function that sends the request, e.g. requests.get
+            args, kwargs: passed to send
+        """
+        self.acquire()
+        res = None
+        try:
+            res = send(*args, **kwargs)
+            return res
+        finally:
+            self.update(getattr(res, 'headers', None))
+
+
+class FetchScheduler:
+    """
+    Fetch several listings at the same time on a pool of threads
+    Parameters:
+        fetch: the function that fetches one listing, called with the listing
+        workers (int): the number of listings to fetch at the same time
+    """
+
+    def __init__(self, fetch, workers: int=max_workers):
+        self.fetch = fetch
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def run_cycle(self, listings: list):
+        """
+        Fetch every listing once and yield each (listing, result)
+        as soon as it is ready
+        Parameters:
+            listings (list): the listings to fetch
+        """
+        futures = {self.executor.submit(self.fetch, listing): listing for listing in listings}
+        for future in as_completed(futures):
+            listing = futures[future]
+            try:
+                yield listing, future.result()
+            except Exception as e:
+                print(f"Error: fetching {listing} failed: {e}")
+
+    def close(self):
+        """
+        Stop the pool of threads
+        """
+        self.executor.shutdown(wait=True)
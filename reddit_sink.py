@@ -0,0 +1,158 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module writes the consumer's output rows to a csv file
+    that stays open for the life of the consumer. Rows are buffered
+    and written when the buffer is full or has waited long enough,
+    files can be synced to disk after each write, and the output
+    file can be rotated once it reaches a size or a new day starts.
+'''
+
+######## imports ########
+import csv
+import os
+import time
+from datetime import date
+
+from reddit_metrics import registry
+
+
+######## declare constants ########
+
+# set how many rows to buffer before writing them to the file
+flush_rows = 100
+
+# set how many seconds a row may wait in the buffer before it is written
+flush_seconds = 5.0
+
+# set when to sync the file to disk:
+# "never" (leave it to the operating system), "flush" (after every write
+# of the buffer), or "always" (write and sync after every row).
+# The consumer acknowledges messages after a flush, so with "never"
+# acknowledged rows may only be in the page cache when the power goes
+fsync_policy = "flush"
+
+# the sync policies that can be chosen
+fsync_policies = ("never", "flush", "always")
+
+
+######## define classes ########
+
+class OutputSink:
+    """
+    Buffer csv rows and append them to an output file
+    Parameters:
+        path (str): the output file
+        flush_rows (int): the number of rows to buffer before writing
+        flush_seconds (float): the longest a row waits in the buffer
+        fsync_policy (str): "never", "flush" or "always"
+        rotate_bytes (int): rotate the file once it reaches this size (None = never)
+        rotate_daily (bool): rotate the file when a new day starts
+    """
+
+    def __init__(self, path: str, flush_rows: int=flush_rows, flush_seconds: float=flush_seconds,
+                 fsync_policy: str=fsync_policy, rotate_bytes: int=None, rotate_daily: bool=False):
+        if fsync_policy not in fsync_policies:
+            raise ValueError(f"fsync_policy must be one of {fsync_policies}")
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.fsync_policy = fsync_policy
+        self.rotate_bytes = rotate_bytes
+        self.rotate_daily = rotate_daily
+        # the file is opened on the first write
+        self.file = None
+        self.writer = None
+        self.opened_on = None
+        self.rows = []
+        self.last_flush = time.monotonic()
+
+    def write_row(self, row: list):
+        """
+        Add a row to the buffer and write the buffer if a
+        size or time threshold has been reached
+        Parameters:
+            row (list): the csv fields of the row
+        """
+        self.rows.append(row)
+        if self.fsync_policy == "always" or len(self.rows) >= self.flush_rows:
+            self.flush()
+        else:
+            self.maybe_flush()
+
+    def maybe_flush(self):
+        """
+        Write the buffer if the oldest row has waited flush_seconds,
+        call this periodically when messages stop arriving
+        """
+        if self.rows and time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered rows to the output file
+        """
+        self.last_flush = time.monotonic()
+        if not self.rows:
+            return
+        with registry.timer("write"):
+            self.rotate_if_needed()
+            if self.file is None:
+                self.open()
+            self.writer.writerows(self.rows)
+            registry.counter("reddit_rows_written_total", "Rows written to the output files",
+                             path=self.path).inc(len(self.rows))
+            self.rows = []
+            self.file.flush()
+            if self.fsync_policy != "never":
+                os.fsync(self.file.fileno())
+
+    def open(self):
+        """
+        Open the output file in append mode
+        """
+        self.file = open(self.path, "a", encoding="utf-8", newline='')
+        self.writer = csv.writer(self.file)
+        self.opened_on = date.today()
+
+    def rotate_if_needed(self):
+        """
+        Move the output file aside once it is too large
+        or was opened on an earlier day
+        """
+        if not os.path.exists(self.path):
+            return
+        too_large = self.rotate_bytes is not None and os.path.getsize(self.path) >= self.rotate_bytes
+        opened_on = self.opened_on or date.fromtimestamp(os.path.getmtime(self.path))
+        new_day = self.rotate_daily and opened_on != date.today()
+        if too_large or new_day:
+            self.rotate(opened_on)
+
+    def rotate(self, opened_on: date):
+        """
+        Close the output file and rename it with its date and a counter,
+        e.g. output_dataanalysis.2023-02-19.1.txt
+        Parameters:
+            opened_on (date): the day the file was started
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.writer = None
+        stem, suffix = os.path.splitext(self.path)
+        counter = 1
+        while os.path.exists(f"{stem}.{opened_on.isoformat()}.{counter}{suffix}"):
+            counter += 1
+        os.replace(self.path, f"{stem}.{opened_on.isoformat()}.{counter}{suffix}")
+
+    def close(self):
+        """
+        Write any buffered rows and close the output file
+        """
+        try:
+            self.flush()
+        finally:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.writer = None
@@ -0,0 +1,165 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module keeps the consumer's posts in a SQLite table with
+    real, typed columns, so they can be queried by subreddit and
+    time range without reparsing the text output files.
+
+        subreddit, flair, created_utc, delta_seconds, title, text, id, score
+
+    delta_seconds is the time since the earlier post of the listing, in
+    created_utc order, for a "gap" listing (r/dataanalysis/new). It is
+    NULL for the first post, a late post and every post of an "age"
+    listing (r/todayilearned/top), whose posts arrive by rank - the age
+    of those posts is found from created_utc when they are read.
+
+    Rows are buffered and inserted in batches in one transaction.
+    created_utc and (subreddit, created_utc) are indexed for range
+    queries, and a post delivered twice is stored once (by id).
+    The store can be flushed and closed like an OutputSink.
+'''
+
+######## imports ########
+import sqlite3
+import time
+
+from reddit_metrics import registry
+
+
+######## declare constants ########
+
+# set the SQLite file the posts are kept in
+store_path = "reddit_posts.db"
+
+# set how many rows to buffer before inserting them
+flush_rows = 100
+
+# set how many seconds a row may wait in the buffer before it is inserted
+flush_seconds = 5.0
+
+# the columns of the posts table, in insert order
+columns = ('subreddit', 'flair', 'created_utc', 'delta_seconds', 'title', 'text', 'id', 'score')
+
+
+######## define classes ########
+
+class PostStore:
+    """
+    Buffer posts and insert them into a SQLite table in batches
+    Parameters:
+        path (str): the SQLite file
+        flush_rows (int): the number of rows to buffer before inserting
+        flush_seconds (float): the longest a row waits in the buffer
+    """
+
+    def __init__(self, path: str=store_path, flush_rows: int=flush_rows, flush_seconds: float=flush_seconds):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        # the file is opened on the first insert
+        self.connection = None
+        self.rows = []
+        self.last_flush = time.monotonic()
+
+    def open(self):
+        """
+        Open the SQLite file and create the table and indexes
+        """
+        self.connection = sqlite3.connect(self.path)
+        # write-ahead logging lets analysts read while the consumer writes,
+        # and each insert is synced to disk before its messages are acknowledged
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS posts (
+                subreddit TEXT NOT NULL,
+                flair TEXT,
+                created_utc INTEGER NOT NULL,
+                delta_seconds REAL,
+                title TEXT,
+                text TEXT,
+                id TEXT UNIQUE,
+                score INTEGER
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS posts_created_utc ON posts (created_utc)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS posts_subreddit_created_utc ON posts (subreddit, created_utc)")
+        self.connection.commit()
+
+    def write_row(self, row: dict):
+        """
+        Add a post to the buffer and insert the buffer if a
+        size or time threshold has been reached
+        Parameters:
+            row (dict): the post, with a value for each of the columns
+        """
+        self.rows.append(tuple(row.get(column) for column in columns))
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+        else:
+            self.maybe_flush()
+
+    def maybe_flush(self):
+        """
+        Insert the buffer if the oldest row has waited flush_seconds
+        """
+        if self.rows and time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """
+        Insert the buffered rows in one transaction
+        """
+        self.last_flush = time.monotonic()
+        if not self.rows:
+            return
+        with registry.timer("store"):
+            if self.connection is None:
+                self.open()
+            with self.connection:
+                # a post delivered again replaces its earlier row
+                self.connection.executemany(
+                    f"INSERT OR REPLACE INTO posts ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                    self.rows)
+        registry.counter("reddit_posts_stored_total", "Posts inserted into the SQLite store").inc(len(self.rows))
+        self.rows = []
+
+    def query(self, subreddit: str=None, start: int=None, end: int=None) -> list:
+        """
+        Get the posts of a subreddit and/or created_utc range,
+        oldest first, using the indexes
+        Parameters:
+            subreddit (str): the subreddit (None = all)
+            start (int): the earliest created_utc, in epoch seconds (None = no limit)
+            end (int): the latest created_utc, in epoch seconds (None = no limit)
+        Returns:
+            a list of dictionaries, one per post
+        """
+        self.flush()
+        if self.connection is None:
+            self.open()
+        conditions = []
+        params = []
+        if subreddit is not None:
+            conditions.append("subreddit = ?")
+            params.append(subreddit)
+        if start is not None:
+            conditions.append("created_utc >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("created_utc <= ?")
+            params.append(end)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.connection.execute(
+            f"SELECT {', '.join(columns)} FROM posts {where} ORDER BY created_utc", params)
+        return [dict(zip(columns, row)) for row in rows]
+
+    def close(self):
+        """
+        Insert any buffered rows and close the SQLite file
+        """
+        try:
+            self.flush()
+        finally:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
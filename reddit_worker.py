@@ -0,0 +1,181 @@
+'''
+    Amanda Hanway - Streaming Data, Module 7
+
+    This module lets the consumer acknowledge messages only after
+    their rows have been written, and process deliveries on a pool
+    of threads or processes.
+
+    Messages are decoded and cleaned on the pool, then finished
+    (time since the earlier post, output row, alert) on the
+    connection thread in the order they arrived on each queue.
+    Finished messages are acknowledged together, with one multiple
+    ack, after the output files have been written. A message that is
+    held back does not stop the finished messages behind it from
+    being acknowledged. A message that could not be processed is
+    rejected without requeueing, so the broker moves it to the
+    dead-letter queue (see reddit_config.py) instead of dropping it.
+
+    pika connections are not thread safe, so the pool never touches
+    the channel: it hands results back with add_callback_threadsafe.
+'''
+
+######## imports ########
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from reddit_metrics import registry
+
+
+######## define classes ########
+
+class AckTracker:
+    """
+    Track the deliveries on a channel and acknowledge them
+    once their rows are written to the output files
+    Parameters:
+        channel: the channel the messages were delivered on
+        sinks (list): the output sinks to write before acknowledging
+        ack_batch (int): the number of finished messages to acknowledge together
+    """
+
+    def __init__(self, channel, sinks: list, ack_batch: int):
+        self.channel = channel
+        self.sinks = sinks
+        self.ack_batch = ack_batch
+        # delivery tags in the order they arrived
+        self.in_flight = deque()
+        # delivery tags whose rows have been handed to a sink
+        self.finished = set()
+        self.last_commit = time.monotonic()
+
+    def received(self, delivery_tag: int):
+        """
+        Record a delivery as it arrives
+        """
+        self.in_flight.append(delivery_tag)
+
+    def done(self, delivery_tag: int):
+        """
+        Record that a delivery's row has been handed to a sink
+        and acknowledge the batch once it is full
+        """
+        self.finished.add(delivery_tag)
+        if len(self.finished) >= self.ack_batch:
+            self.commit()
+
+    def failed(self, delivery_tag: int):
+        """
+        Reject a delivery that could not be processed, the broker
+        moves it to the queue's dead-letter exchange to be looked at
+        and published again later
+        """
+        registry.counter("reddit_messages_failed_total", "Messages that could not be processed").inc()
+        self.channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+        self.in_flight.remove(delivery_tag)
+
+    def commit(self):
+        """
+        Write the output files, then acknowledge every finished
+        delivery, those with no unfinished delivery before them
+        with a single multiple ack
+        """
+        self.last_commit = time.monotonic()
+        if not self.finished:
+            return
+        for sink in self.sinks:
+            sink.flush()
+        last_tag = None
+        while self.in_flight and self.in_flight[0] in self.finished:
+            last_tag = self.in_flight.popleft()
+            self.finished.discard(last_tag)
+        if last_tag is not None:
+            # one ack covers every delivery tag up to and including last_tag
+            self.channel.basic_ack(delivery_tag=last_tag, multiple=True)
+        if self.finished:
+            # a message held back (e.g. in the reorder buffer) must not
+            # fill the prefetch window, so the finished deliveries
+            # behind it are acknowledged one by one
+            for delivery_tag in sorted(self.finished):
+                self.channel.basic_ack(delivery_tag=delivery_tag)
+            self.in_flight = deque(tag for tag in self.in_flight if tag not in self.finished)
+            self.finished.clear()
+
+    def commit_if_due(self, seconds: float):
+        """
+        Acknowledge finished deliveries that have waited long enough,
+        call this periodically when messages stop arriving
+        Parameters:
+            seconds (float): the longest to wait between acknowledgements
+        """
+        if self.finished and time.monotonic() - self.last_commit >= seconds:
+            self.commit()
+
+
+class OrderedWorkerPool:
+    """
+    Run the parse step of each message on a pool of workers and
+    finish the messages of each queue in the order they arrived
+    Parameters:
+        connection: the blocking connection to the RabbitMQ server
+        tracker (AckTracker): records finished deliveries
+        workers (int): the number of threads or processes
+        use_processes (bool): use processes (True) to spread the work
+            across cores, or threads (False)
+    """
+
+    def __init__(self, connection, tracker: AckTracker, workers: int, use_processes: bool=True):
+        self.connection = connection
+        self.tracker = tracker
+        if use_processes:
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        # per queue, the (delivery tag, future, finish) of each message in arrival order
+        self.queues = {}
+
+    def submit(self, queue_name: str, delivery_tag: int, parse, args: tuple, finish):
+        """
+        Start the parse step of a message on the pool
+        Parameters:
+            queue_name (str): the queue the message came from
+            delivery_tag (int): the delivery tag of the message
+            parse: a module level function run on the pool with args
+            args (tuple): the arguments for parse
+            finish: a function run on the connection thread with the parse result
+                and the delivery tag, returning the delivery tags whose rows are
+                now written (a message it holds back is returned by a later call)
+                and the delivery tags of held messages that could not be written
+        """
+        self.tracker.received(delivery_tag)
+        future = self.executor.submit(parse, *args)
+        self.queues.setdefault(queue_name, deque()).append((delivery_tag, future, finish))
+        # hand control back to the connection thread once the parse is done
+        future.add_done_callback(lambda f: self.connection.add_callback_threadsafe(self.drain))
+
+    def drain(self):
+        """
+        Finish the parsed messages at the front of each queue,
+        stopping at the first message still being parsed so the
+        output keeps the arrival order of each queue
+        """
+        for pending in self.queues.values():
+            while pending and pending[0][1].done():
+                delivery_tag, future, finish = pending.popleft()
+                try:
+                    finished, failed = finish(future.result(), delivery_tag)
+                except Exception as e:
+                    print(f"ERROR: message {delivery_tag} could not be processed: {e}")
+                    self.tracker.failed(delivery_tag)
+                    continue
+                for tag in finished:
+                    self.tracker.done(tag)
+                for tag in failed:
+                    self.tracker.failed(tag)
+
+    def shutdown(self):
+        """
+        Wait for the messages on the pool and finish them
+        """
+        self.executor.shutdown(wait=True)
+        self.drain()
@@ -2,135 +2,339 @@
     Amanda Hanway - Streaming Data, Module 7
     Date: 2/4/23
 
-    This program gets posts from reddit.com using the API 
-    and then writes the data to a csv file. This is the base code 
-    taken from the link below, and was helpful to view how the data 
+    This program gets posts from reddit.com using the API
+    and then writes the data to a csv file. This is the base code
+    taken from the link below, and was helpful to view how the data
     is pulled before writing the producer program.
 
+    It can also backfill history: each page is appended to the csv
+    file as soon as it arrives and the 'after' cursor is saved to a
+    checkpoint file, so a stopped backfill resumes where it left off.
+    The listings are read from reddit_config.json, and several are
+    backfilled at the same time within one rate budget. The posts can
+    be published, oldest first, to the same topic exchange and queues
+    as the live producer.
+
+    Usage: python reddit_api_base.py [--pages 3] [--bind reddit.#] [--publish] [--help for more]
+
     Reddit API Base Code Source: "How to Use the Reddit API in Python"
-    -Link: https://towardsdatascience.com/how-to-use-the-reddit-api-in-python-5e05ddfd1e5c 
+    -Link: https://towardsdatascience.com/how-to-use-the-reddit-api-in-python-5e05ddfd1e5c
 '''
 
 ######## imports ########
-import requests
-import pandas as pd
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import threading
 from datetime import datetime
 
+# use the reddit api client shared with the producer in the parent folder
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(repo_dir)
+from reddit_client import Post, RedditClient, posts_from_response
+from reddit_config import ListingConfig, load_config, load_credentials, queue_arguments, select_listings
+from reddit_scheduler import FetchScheduler, RateLimiter
+
 
 ######## declare constants ########
 
-# set reddit connection credentials from a file
-# to keep my credentials private 
-cred = pd.read_csv('reddit_login_credentials.txt')
-username = cred.loc[0][0]
-password = cred.loc[1][0]
-dev_app_name = cred.loc[2][0]
-personal_use_script = cred.loc[3][0]
-secret_token = cred.loc[4][0]
+# the reddit connection credentials are read from environment variables
+# or a file when the backfill starts, to keep my credentials private
+# (see load_credentials in reddit_config.py)
+
+# set the reddit api url
+api_url = "https://oauth.reddit.com"
 
-# set source page url - latest posts on the r/dataanalysis subreddit 
-web_page = "https://oauth.reddit.com/r/dataanalysis/new/"
+# set the file that lists the subreddit listings (see reddit_config.py)
+config_path = os.path.join(repo_dir, "reddit_config.json")
 
-# set how many posts to return (n * 100 per batch)
+# set the routing keys of the listings to backfill, e.g. "reddit.#" for
+# every listing - by default the latest posts on the r/dataanalysis subreddit
+backfill_pattern = "reddit.dataanalysis.new"
+
+# set the csv file a listing is written to, by name
+# (any other listing is written to data_<subreddit>_<listing>.csv)
+backfill_files = {"dataanalysis.new": "data.csv"}
+
+# set how many pages to request from each listing (n * 100 posts),
+# None to keep going until the listing ends
 post_count = 3
 
+# set the file that records how far each listing got
+checkpoint_path = "backfill_checkpoint.json"
+
+# set how many listings to backfill at the same time
+backfill_workers = 4
+
+# set to publish the posts to the producer's exchange once a listing is
+# written (True) or only write the csv files (False). Posts the producer
+# has already published are skipped using its seen index.
+publish_backfill = False
+host = "localhost"
+seen_index_path = "seen_posts.db"
+
+# the csv columns: the row number, then the post fields
+csv_header = [''] + list(Post.fields)
+
 
 ######## define functions ########
 
+def format_created(created_utc: int) -> str:
+    '''
+    Format the epoch seconds of a post as in data.csv
+    '''
+    return datetime.fromtimestamp(created_utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def parse_created(created: str) -> int:
+    '''
+    Get the epoch seconds back from a data.csv timestamp
+    '''
+    return int(datetime.strptime(created, '%Y-%m-%dT%H:%M:%SZ').timestamp())
+
 def df_from_response(res):
     '''
     Convert responses to a dataframe
     '''
-    # initialize temp dataframe for batch of data in response
-    df = pd.DataFrame()
-
-    # loop through each post pulled from res and append to df_list
-    df_list = []
-    for post in res.json()['data']['children']:
-        df_list.append({    
-            'subreddit': post['data']['subreddit'],
-            'title': post['data']['title'],
-            'selftext': post['data']['selftext'],
-            'upvote_ratio': post['data']['upvote_ratio'],
-            'ups': post['data']['ups'],
-            'downs': post['data']['downs'],
-            'score': post['data']['score'],
-            'link_flair_css_class': post['data']['link_flair_css_class'],
-            'created_utc': datetime.fromtimestamp(post['data']['created_utc']).strftime('%Y-%m-%dT%H:%M:%SZ'),
-            'id': post['data']['id'],
-            'kind': post['kind']
-        })
-    
-    # convert the list of dictionaries to a dataframe
-    df = pd.DataFrame.from_dict(df_list)
+    # get the posts from the shared parser as a dataframe
+    df = posts_from_response(res).to_dataframe()
+    df['created_utc'] = [format_created(t) for t in df['created_utc']]
 
     return df
 
-def make_request(un: str=username, pw: str=password, app_nm: str=dev_app_name, pg: str=web_page):
-    '''
-    Request an OAuth token and connect the reddit api 
-    then request data from the webpage and add it to a dataframe
-    '''
-    # authenticate API
-    client_auth = requests.auth.HTTPBasicAuth(personal_use_script, secret_token)
-    data = {
-        'grant_type': 'password',
-        'username': un,
-        'password': pw
-    }
-    headers = {'User-Agent': app_nm}
-
-    # send authentication request for OAuth token
-    res = requests.post('https://www.reddit.com/api/v1/access_token',
-                        auth=client_auth, data=data, headers=headers)
-    # extract token from response and format correctly
-    token = f"bearer {res.json()['access_token']}"
-    # update API headers with authorization (bearer token)
-    headers = {**headers, **{'Authorization': token}}
-
-    # initialize dataframe and parameters for pulling data in loop
-    data = pd.DataFrame()
+def record_from_row(row: list) -> dict:
+    '''
+    Convert a data.csv row back to a post record for publishing
+    Parameters:
+        row (list): the csv fields, starting with the row number
+    '''
+    record = dict(zip(Post.fields, row[1:]))
+    record['upvote_ratio'] = float(record['upvote_ratio'])
+    for field in ('ups', 'downs', 'score'):
+        record[field] = int(record[field])
+    record['created_utc'] = parse_created(record['created_utc'])
+    # csv writes a missing flair as an empty field
+    record['link_flair_css_class'] = record['link_flair_css_class'] or None
+    return record
+
+def backfill_path(listing: ListingConfig) -> str:
+    '''
+    Get the csv file a listing is backfilled to
+    '''
+    return backfill_files.get(listing.name, f"data_{listing.subreddit}_{listing.listing}.csv")
+
+def backfill_listing(client: RedditClient, pg: str, output_path: str, checkpoint, max_pages: int=post_count) -> dict:
+    '''
+    Page through a listing with 'after' and append each page to the
+    csv file, saving the checkpoint after every page. A backfill that
+    was stopped resumes from its checkpoint, and anything written to
+    the file after the last checkpoint is cut off first so no post is
+    written twice.
+    Parameters:
+        client (RedditClient): the shared reddit api client
+        pg (str): the listing url
+        output_path (str): the csv file
+        checkpoint (Checkpoint): the progress of each listing
+        max_pages (int): the most pages to request (None = until the listing ends)
+    Returns:
+        the progress of the listing
+    '''
+    state = checkpoint.get(pg)
+    if state['done']:
+        return state
+
+    if state['offset'] == 0:
+        # a new file starts with the header
+        data_file = open(output_path, 'wb')
+        header = io.StringIO()
+        csv.writer(header).writerow(csv_header)
+        data_file.write(header.getvalue().encode('utf-8'))
+        state['offset'] = data_file.tell()
+    else:
+        data_file = open(output_path, 'r+b')
+        data_file.truncate(state['offset'])
+        data_file.seek(state['offset'])
+
     params = {'limit': 100}
+    if state['after'] is not None:
+        params['after'] = state['after']
+
+    with data_file:
+        while max_pages is None or len(state['pages']) < max_pages:
+            # make request
+            posts = client.get_posts(pg, params=params)
+            if len(posts) == 0:
+                state['done'] = True
+                break
+
+            # write the page in one piece, numbering the rows on from the last page
+            page = io.StringIO()
+            writer = csv.writer(page)
+            for number, post in enumerate(posts, start=state['rows']):
+                writer.writerow([number] + [format_created(post.created_utc) if field == 'created_utc'
+                                            else getattr(post, field) for field in Post.fields])
+            data_file.write(page.getvalue().encode('utf-8'))
+            data_file.flush()
+            os.fsync(data_file.fileno())
+
+            # the page is on disk, move the checkpoint past it
+            state['pages'].append(state['offset'])
+            state['offset'] = data_file.tell()
+            state['rows'] += len(posts)
+            # page forward from the final post (oldest entry)
+            state['after'] = params['after'] = posts[-1].fullname
+            # a short page means the end of the listing was reached
+            state['done'] = len(posts) < params['limit']
+            checkpoint.save(pg, state)
+            print(f" [x] {pg}: {state['rows']} posts written to {output_path}")
+            if state['done']:
+                break
+
+    checkpoint.save(pg, state)
+    return state
+
+def publish_listing(output_path: str, state: dict, listing: ListingConfig, config: dict):
+    '''
+    Publish the posts of a backfilled listing to the topic exchange with
+    the listing's routing key, as the producer does, oldest first,
+    one page at a time, skipping the posts already published
+    Parameters:
+        output_path (str): the csv file
+        state (dict): the progress of the listing, with the offset of each page
+        listing (ListingConfig): the listing
+        config (dict): the configuration, with the exchange name
+    '''
+    # pika is only needed when publishing
+    import pika
+    from reddit_dedup import SeenIndex
+    from reddit_message import compress_message, content_type, encode_message, message_headers
+    from reddit_publisher import Publisher, delivery_mode
+
+    offsets = state['pages'] + [state['offset']]
+    seen = SeenIndex(seen_index_path)
+    publisher = Publisher(host)
+    # route the listing into its queue, declared as the producer declares it
+    publisher.bind(config['exchange'], listing.queue, listing.routing_key, arguments=queue_arguments(config))
+    try:
+        with open(output_path, 'rb') as data_file:
+            # the file goes from newest to oldest, so read the pages backward
+            for start, end in reversed(list(zip(offsets, offsets[1:]))):
+                data_file.seek(start)
+                rows = csv.reader(io.StringIO(data_file.read(end - start).decode('utf-8')))
+                records = [record_from_row(row) for row in reversed(list(rows))]
+                unseen = seen.unseen(record['id'] for record in records)
+                for record in records:
+                    if record['id'] in unseen:
+                        body, content_encoding = compress_message(encode_message(record))
+                        properties = pika.BasicProperties(content_type=content_type, content_encoding=content_encoding,
+                                                          headers=message_headers(), delivery_mode=delivery_mode)
+                        publisher.publish(listing.routing_key, body, properties, config['exchange'])
+                # remember the posts once the broker has confirmed them
+                publisher.flush()
+                seen.add(list(unseen))
+        print(f" [x] {output_path}: published to {listing.queue}")
+    finally:
+        publisher.close()
+        seen.close()
+
+def make_request(un: str=None, pw: str=None, app_nm: str=None, pattern: str=None):
+    '''
+    Request an OAuth token and connect the reddit api
+    then backfill each listing to its csv file, resuming from the
+    checkpoint, and publish the posts if turned on
+    Parameters:
+        un, pw, app_nm (str): the reddit username, password and app name (None = from the credentials)
+        pattern (str): the routing keys of the listings to backfill (None = backfill_pattern)
+    '''
+    # read the listings to backfill, by url
+    config = load_config(config_path)
+    listings = select_listings(config['listings'], pattern or backfill_pattern)
+    if not listings:
+        raise ValueError(f"no listing in {config_path} matches {pattern or backfill_pattern}")
+    pages = {listing.url(api_url): listing for listing in listings}
 
-    # create a list to store the data
-    data_list = []
-
-    # loop through n times (returning n*100 posts)
-    for i in range(post_count):
-        # make request
-        res = requests.get(pg,
-                        headers=headers,
-                        params=params)
-
-        # get dataframe from response
-        new_df = df_from_response(res)
-        # take the final row (oldest entry)
-        row = new_df.iloc[len(new_df)-1]
-        # create fullname
-        fullname = row['kind'] + '_' + row['id']
-        # add/update fullname in params
-        params['after'] = fullname
-        
-        # append new_df to the data_list
-        data_list.append(new_df)   
-
-    # concatenate data_list to the data dataframe
-    data = pd.concat(data_list, ignore_index=True)     
-    
-    # preview data 
-    print(data)  
-    data.to_csv('data.csv', encoding='utf-8', index=True)
+    cred = load_credentials()
+    # share one rate budget between the listings fetched at the same time
+    limiter = RateLimiter()
+    # create the api client, it requests the OAuth token on first use
+    client = RedditClient(un or cred.username, pw or cred.password, app_nm or cred.dev_app_name,
+                          cred.personal_use_script, cred.secret_token, limiter=limiter)
+
+    checkpoint = Checkpoint(checkpoint_path)
+    scheduler = FetchScheduler(lambda pg: backfill_listing(client, pg, backfill_path(pages[pg]), checkpoint, post_count),
+                               backfill_workers)
+    try:
+        # publish each listing as soon as its backfill is done
+        for pg, state in scheduler.run_cycle(list(pages)):
+            print(f" [x] {pg}: {state['rows']} posts in {backfill_path(pages[pg])}")
+            if publish_backfill:
+                publish_listing(backfill_path(pages[pg]), state, pages[pg], config)
+    finally:
+        scheduler.close()
+        client.close()
+
+
+######## define classes ########
+
+class Checkpoint:
+    '''
+    The progress of each listing, saved to a json file:
+    the 'after' cursor, the number of rows, the file offset
+    after the last written page and where each page starts
+    Parameters:
+        path (str): the checkpoint file
+    '''
+
+    def __init__(self, path: str=checkpoint_path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, encoding='utf-8') as checkpoint_file:
+                self.listings = json.load(checkpoint_file)
+        except FileNotFoundError:
+            self.listings = {}
+
+    def get(self, pg: str) -> dict:
+        '''
+        Get the progress of a listing (a new listing starts at the beginning)
+        '''
+        with self.lock:
+            state = self.listings.get(pg, {'after': None, 'rows': 0, 'offset': 0, 'pages': [], 'done': False})
+            return json.loads(json.dumps(state))
+
+    def save(self, pg: str, state: dict):
+        '''
+        Save the progress of a listing, replacing the file in one step
+        '''
+        with self.lock:
+            self.listings[pg] = json.loads(json.dumps(state))
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as checkpoint_file:
+                json.dump(self.listings, checkpoint_file)
+            os.replace(temp_path, self.path)
 
 
 # Standard Python idiom to indicate main program entry point
 # This allows us to import this module and use its functions
 # without executing the code below.
 # If this is the program being run, then execute the code below
-if __name__ == "__main__":  
-
-    make_request()
-
-  
-
+if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Backfill reddit listings to csv files")
+    parser.add_argument("--pages", type=int, default=post_count,
+                        help="pages of 100 posts per listing (0 = until the listing ends)")
+    parser.add_argument("--checkpoint", default=checkpoint_path, help="the checkpoint file")
+    parser.add_argument("--config", default=config_path, help="the listings file, see reddit_config.py")
+    parser.add_argument("--bind", default=backfill_pattern,
+                        help="the routing keys of the listings to backfill, e.g. reddit.#")
+    parser.add_argument("--publish", action="store_true", default=publish_backfill,
+                        help="publish the posts to the producer's queues")
+    args = parser.parse_args()
+    post_count = args.pages or None
+    checkpoint_path = args.checkpoint
+    config_path = args.config
+    publish_backfill = args.publish
 
+    make_request(pattern=args.bind)